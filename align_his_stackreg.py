@@ -2,7 +2,7 @@
 # @Author:        F. Paul Spitzner
 # @Email:         paul.spitzner@ds.mpg.de
 # @Created:       2020-01-13 19:14:56
-# @Last Modified: 2020-02-06 13:49:16
+# @Last Modified: 2026-10-17 11:34:52
 # ------------------------------------------------------------------------------ #
 # Align ROIs (points) that were found on one dataset to the coordinate
 # system of another dataset (for instance, a day later)
@@ -53,6 +53,9 @@ mov_img_file_list = [
 mov_roi_saveto = "D:/experiments/paul/register/dat/roi/"
 # size of the square to assign to each roi
 roi_width = 10
+# additionally, save the aligned rois of all files (including those skipped as
+# up to date) into one .npz with roi_id, x and y (files * rois). None to skip.
+all_rois_npz = None  # e.g. "D:/experiments/paul/register/dat/roi/all_rois.npz"
 
 # where to save the image previews with aligned rois drawn.
 # this folder is checked for existing files and if the target is found,
@@ -60,6 +63,16 @@ roi_width = 10
 # images and run again with different parameters
 mov_img_saveto = "D:/experiments/paul/register/dat/img/"
 
+# remember with which inputs (stacks, roi file, parameters) every output was
+# created. a rerun then redoes exactly the outputs whose inputs changed (or that
+# were deleted), and keeps the transformations if only the rois changed.
+# None to only skip files whose preview exists, no matter how it was created.
+run_manifest = "D:/experiments/paul/register/dat/manifest.json"
+
+# additionally, save all previews of this run (downscaled by this factor) side by
+# side into `contact_sheet.png` in the folder above. None to skip.
+contact_sheet_factor = 4
+
 
 # use only the first frame of each stack or compute an average. average takes longer
 # as the whole stack might have to be checked but produces much better results.
@@ -68,154 +81,301 @@ use_average = True
 # how many frames to draw from the whole stack (spread evenly from beginning to end)
 frames_for_average = 1000
 
-import numpy as np
-import utility as ut
-
-# load the regions of interest. we are using image coordinates!
-ref_roi_dat = np.loadtxt(ref_roi_file, delimiter=",", skiprows=1)
-cols = ref_roi_dat[:, 2]  # image coordinates, left to right
-rows = ref_roi_dat[:, 1]  # image coordinates, top to bottom
-roid = ref_roi_dat[:, 0]  # id of the region of interest
-# to transform from netcals cartestian coordinates, you can do this:
-# cols, rows = ut.cartesian_to_image_coordinates(x=ref_roi_dat[:, 1], y=ref_roi_dat[:, 2], width=1024)
-
-# ------------------------------------------------------------------ #
-# main script
-# ------------------------------------------------------------------ #
-
-from skimage import io
-from skimage import transform as tf
-from skimage import exposure
-from pystackreg import StackReg  # pip install pystackreg
+# how to pick these frames: "even" takes single frames, "blocks" takes short runs
+# of consecutive frames (still spread over the whole stack), which needs
+# far fewer seeks and is much faster on spinning disks and network shares
+frame_sampling = "even"
+
+# first estimate the drift on downscaled images (phase correlation) and only then
+# refine with stackreg. much more robust when sessions are shifted a lot.
+# set False to run stackreg from scratch, as before.
+coarse_to_fine = True
+# also estimate the rotation in the first step, only needed for large rotations
+# (more than a few degree), small ones are found by stackreg anyway.
+estimate_rotation = False
+
+# build a consensus template: align all files, average them (moved onto the
+# reference) and align them again to this average, which is much less noisy than
+# the reference alone. the rois still refer to the reference.
+# number of passes against the average, 0 to align to the reference only.
+template_passes = 0
+# files whose transformation changed by less than this (pixels) in a pass
+# are not aligned again
+template_tolerance = 0.5
+
+# the averaged images are cached, so changing the parameters below does not
+# require to read all stacks again. set to None to disable the cache.
+projection_cache_dir = "~/.cache/his_stackreg/projections"
+projection_cache_max_gb = 5
+
+# how many files to align in parallel. each worker process holds one stack
+# projection in memory. None to use one process per cpu.
+num_workers = 4
+
+# how many stacks to read from disk in the background while others are aligned.
+# at most max_prefetch stacks are read ahead, each needs one projection in memory
+num_readers = 2
+max_prefetch = 2
+
+# for watch.py (service mode): the folder where new recordings appear. every .his
+# file in it is aligned as soon as it is complete, i.e. its size did not change
+# for watch_stable_polls checks (every watch_interval seconds) and all frames
+# announced in its header are written.
+watch_folder = "I:/PAUL/"
+watch_interval = 30
+watch_stable_polls = 2
+# recordings already in the folder when the service starts are skipped (unless
+# they are still being written). True to align them, too
+watch_include_existing = False
+
+# time every step (reading, consistency check, projection, registration, export)
+# and save the timings and bytes read per file as json to this path.
+# None to skip.
+timing_report = None  # e.g. "D:/experiments/paul/register/dat/timings.json"
 
 import os
 import os.path as op
-from his_opener import HisOpener
-
-try:
-    import matplotlib
-    import matplotlib.pyplot as plt
+import numpy as np
+import utility as ut
+import pipeline
+import preview
+import template
+from projection_cache import ProjectionCache, file_identity
+from manifest import RunManifest, fingerprint, file_hash
 
-    plt.ioff()  # turn off interactive so figures dont pop up, show with plt.show()
-except ImportError:
-    plt = None
 
-# check which files to produce
-mov_roi_saveto_list = []
-mov_img_saveto_list = []
-mov_img_already_done = []
-for idx, file in enumerate(mov_img_file_list):
+def output_paths(file):
+    """
+        where to save the aligned rois and the preview of a file
+    """
     base = ut.base_name(file)
     roi_path = op.join(op.abspath(mov_roi_saveto), base) + "_roi.csv"
     img_path = op.join(op.abspath(mov_img_saveto), base) + "_roi.png"
-    mov_roi_saveto_list.append(roi_path)
-    mov_img_saveto_list.append(img_path)
-    mov_img_already_done.append(op.exists(img_path))
-
-# create output folders
-os.makedirs(mov_img_saveto, mode=0o777, exist_ok=True)
-os.makedirs(mov_roi_saveto, mode=0o777, exist_ok=True)
-
-# create list of points from the original ROIs
-ref_points = np.vstack((cols, rows, roid)).T
-
-# load source image
-ref_his = HisOpener(ref_img_file, skip_consistency_check=True)
-if use_average:
-    ref_img = ref_his.read_frame_average(frames_for_average)
-else:
-    ref_img = ref_his.read_frame(0)
-width = ref_his.width
-height = ref_his.height
-
-# increase the image contrast. this improved the results from stackreg drastically
-# https://scikit-image.org/docs/dev/auto_examples/color_exposure/plot_equalize.html#sphx-glr-auto-examples-color-exposure-plot-equalize-py
-p2, p98 = np.percentile(ref_img, (2, 98))
-ref_img = exposure.rescale_intensity(ref_img, in_range=(p2, p98))
-# ref_img = exposure.equalize_hist(ref_img)
-
-# save the original rois just for good measure
-x, y, i = ref_points[:].T
-temp = op.join(op.abspath(mov_roi_saveto), ut.base_name(ref_img_file))
-ut.save_rois(fname=f"{temp}_roi.csv", roi_id=i, x=x, y=y, roi_width=roi_width)
-
-# quick and dirty, export the original for comparison
-if plt is not None:
-    ref_mask = np.zeros(shape=(width, height, 4), dtype="uint8")
-    for point in ref_points:
-        ut.paint_roi(point[0], point[1], roi_width, ref_mask, channel=0)
-
-    # create a figure, this involves some ugly code to get rid of the borders
-    bbox = matplotlib.transforms.Bbox(((0, 0), (width / 100, height / 100)))
-    fig = plt.figure(figsize=(width / 100, height / 100))  # using 100 dpi
-    ax = plt.Axes(fig, [0.0, 0.0, 1.0, 1.0])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    # here we plot both things
-    ax.imshow(ref_img, cmap="gray")
-    ax.imshow(ref_mask)
-    temp = op.join(op.abspath(mov_img_saveto), ut.base_name(ref_img_file))
-    plt.savefig(f"{temp}_roi.png", bbox_inches=bbox, pad_inches=0.0, dpi=100)
-
-
-# process every target stack
-for idx, mov_img_path in enumerate(mov_img_file_list):
-    if mov_img_already_done[idx]:
-        print(f"Skipping {mov_img_path}")
-        continue
-    mov_his = HisOpener(mov_img_path, skip_consistency_check=True)
-    if use_average:
-        mov_img = mov_his.read_frame_average(frames_for_average)
-    else:
-        mov_img = mov_his.read_frame(0)
-    del mov_his
-
-    print(f"Aligning {mov_img_path}")
-
-    # increase the image contrast. this improved the results from stackreg drastically
-    p2, p98 = np.percentile(mov_img, (2, 98))
-    mov_img = exposure.rescale_intensity(mov_img, in_range=(p2, p98))
-
-    # find the transformation matrix
-    # we only use rigid body, gives: x shift, y shift, rotation
-    sreg = StackReg(StackReg.RIGID_BODY)
-    tmat = sreg.register(ref=ref_img, mov=mov_img)
-
-    # if average_over_experiments:
-    #     out_img = sreg.transform(mov=mov_img, tmat=tmat)
-    #     ref_img = np.mean([ref_img, out_img], axis=0)
-
-    # apply the matrix to the old ROIs
-    # this is essentially just:
-    # src = np.vstack((x, y, np.ones_like(x)))
-    # dst = src.T @ matrix.T
-    mov_points = np.copy(ref_points)
-    mov_points[:, 0:2] = tf.matrix_transform(coords=ref_points[:, 0:2], matrix=tmat)
-
-    # save in netcals image format. import via "load roi (legacy)"
-    x, y, i = mov_points[:].T
+    return roi_path, img_path
+
+
+def fingerprints(file, ref_identity, roi_hash, template_desc=None):
+    """
+        fingerprints of everything the transformation of a file depends on
+        and of everything its outputs depend on, see manifest.py
+    """
+    parts = dict(
+        mov=file_identity(file),
+        ref=ref_identity,
+        use_average=use_average,
+        frames_for_average=frames_for_average,
+        frame_sampling=frame_sampling,
+        coarse_to_fine=coarse_to_fine,
+        estimate_rotation=estimate_rotation,
+    )
+    if template_desc is not None:
+        # with a consensus template, every file depends on all others
+        parts["template"] = template_desc
+    transform_fp = fingerprint(**parts)
+    output_fp = fingerprint(
+        transform=transform_fp,
+        rois=roi_hash,
+        roi_width=roi_width,
+        outputs=output_paths(file),
+    )
+    return transform_fp, output_fp
+
+
+def load_reference():
+    """
+        loads the reference rois and image, saves their preview.
+        returns the stretched reference image, the rois (col, row, id)
+        and a thumbnail of the preview for the contact sheet
+    """
+    # load the regions of interest. we are using image coordinates!
+    ref_roi_dat = np.loadtxt(ref_roi_file, delimiter=",", skiprows=1)
+    cols = ref_roi_dat[:, 2]  # image coordinates, left to right
+    rows = ref_roi_dat[:, 1]  # image coordinates, top to bottom
+    roid = ref_roi_dat[:, 0]  # id of the region of interest
+    # to transform from netcals cartestian coordinates, you can do this:
+    # cols, rows = ut.cartesian_to_image_coordinates(x=ref_roi_dat[:, 1], y=ref_roi_dat[:, 2], width=1024)
+
+    # create output folders
+    os.makedirs(mov_img_saveto, mode=0o777, exist_ok=True)
+    os.makedirs(mov_roi_saveto, mode=0o777, exist_ok=True)
+
+    # create list of points from the original ROIs
+    ref_points = np.vstack((cols, rows, roid)).T
+
+    # load source image and increase the contrast
+    cache = None
+    if projection_cache_dir is not None:
+        cache = ProjectionCache(
+            projection_cache_dir, projection_cache_max_gb * 1024 ** 3
+        )
+    ref_img = pipeline.load_image(
+        ref_img_file, use_average, frames_for_average, frame_sampling, cache
+    )
+    ref_img = pipeline.stretch_contrast(ref_img)
+
+    # save the original rois just for good measure
+    x, y, i = ref_points[:].T
+    temp = op.join(op.abspath(mov_roi_saveto), ut.base_name(ref_img_file))
     ut.save_rois(
-        fname=mov_roi_saveto_list[idx], roi_id=i, x=x, y=y, roi_width=roi_width
+        fname=f"{temp}_roi.csv",
+        roi_id=i,
+        x=x,
+        y=y,
+        roi_width=roi_width,
+        img_width=ref_img.shape[1],
+        img_height=ref_img.shape[0],
     )
 
-    # plot to check if alignment worked and compare
-    if plt is not None:
-        mov_mask = np.zeros(shape=(width, height, 4), dtype="uint8")
-        for point in mov_points:
-            ut.paint_roi(point[0], point[1], roi_width, mov_mask, channel=2)
-
-        # create a figure, this involves some ugly code to get rid of the borders
-        bbox = matplotlib.transforms.Bbox(((0, 0), (width / 100, height / 100)))
-        fig = plt.figure(figsize=(width / 100, height / 100))  # using 100 dpi
-        ax = plt.Axes(fig, [0.0, 0.0, 1.0, 1.0])
-        ax.set_axis_off()
-        fig.add_axes(ax)
-        # but here we plot both things
-        ax.imshow(mov_img, cmap="gray")
-        ax.imshow(mov_mask)
-        plt.savefig(
-            f"{mov_img_saveto_list[idx]}", bbox_inches=bbox, pad_inches=0.0, dpi=100
+    # quick and dirty, export the original for comparison
+    temp = op.join(op.abspath(mov_img_saveto), ut.base_name(ref_img_file))
+    ref_thumbnail = preview.save_preview(
+        f"{temp}_roi.png", ref_img, ref_points, roi_width, 0, contact_sheet_factor
+    )
+    return ref_img, ref_points, ref_thumbnail
+
+
+def main():
+    # check which files to produce
+    manifest = None
+    if run_manifest is not None:
+        manifest = RunManifest(run_manifest)
+        ref_identity = file_identity(ref_img_file)
+        roi_hash = file_hash(ref_roi_file)
+        template_desc = None
+        if template_passes > 0:
+            template_desc = dict(
+                passes=template_passes,
+                tolerance=template_tolerance,
+                files=[
+                    file_identity(f) if op.exists(f) else f for f in mov_img_file_list
+                ],
+            )
+    jobs = []
+    fps = dict()
+    for idx, file in enumerate(mov_img_file_list):
+        roi_path, img_path = output_paths(file)
+        if manifest is None:
+            if op.exists(img_path):
+                print(f"Skipping {file}")
+                continue
+            jobs.append((file, roi_path, img_path))
+            continue
+        try:
+            fps[file] = fingerprints(file, ref_identity, roi_hash, template_desc)
+        except FileNotFoundError:
+            # fails (and is reported) when aligning
+            jobs.append((file, roi_path, img_path))
+            continue
+        if manifest.is_current(file, *fps[file]):
+            print(f"Skipping {file}, up to date")
+            continue
+        tmat = manifest.transform(file, fps[file][0])
+        if tmat is not None:
+            print(f"Reusing transformation of {file}")
+        jobs.append((file, roi_path, img_path, tmat))
+
+    ref_img, ref_points, ref_thumbnail = load_reference()
+
+    # only if some (existing) file still needs its transformation
+    needs_tmat = [
+        op.exists(job[0]) and (len(job) < 4 or job[3] is None) for job in jobs
+    ]
+    if template_passes > 0 and any(needs_tmat):
+        res = template.build_template(
+            ref_img,
+            mov_img_file_list,
+            passes=template_passes,
+            tolerance=template_tolerance,
+            num_workers=num_workers,
+            use_average=use_average,
+            frames_for_average=frames_for_average,
+            frame_sampling=frame_sampling,
+            projection_cache_dir=projection_cache_dir,
+            projection_cache_bytes=projection_cache_max_gb * 1024 ** 3,
+            estimate_rotation=estimate_rotation,
+        )
+        preview.save_preview(
+            op.join(op.abspath(mov_img_saveto), "consensus_template_roi.png"),
+            res["template"],
+            ref_points,
+            roi_width,
+            0,
         )
+        # the transformations to the template are in reference coordinates,
+        # so only the rois and previews are left to do
+        jobs = [
+            job[0:3] + (res["tmats"].get(job[0]),)
+            if len(job) < 4 or job[3] is None
+            else job
+            for job in jobs
+        ]
+
+    # process every target stack
+    results = pipeline.align_batch(
+        jobs,
+        ref_img,
+        ref_points,
+        roi_width=roi_width,
+        use_average=use_average,
+        frames_for_average=frames_for_average,
+        frame_sampling=frame_sampling,
+        projection_cache_dir=projection_cache_dir,
+        projection_cache_bytes=projection_cache_max_gb * 1024 ** 3,
+        thumbnail_factor=contact_sheet_factor,
+        coarse_to_fine=coarse_to_fine,
+        estimate_rotation=estimate_rotation,
+        num_workers=num_workers,
+        num_readers=num_readers,
+        max_prefetch=max_prefetch,
+        instrument=timing_report is not None,
+        report_path=timing_report,
+    )
+    if contact_sheet_factor is not None:
+        preview.save_contact_sheet(
+            op.join(op.abspath(mov_img_saveto), "contact_sheet.png"),
+            thumbnails=[ref_thumbnail] + [res["thumbnail"] for res in results],
+            labels=[ut.base_name(ref_img_file)]
+            + [ut.base_name(res["file"]) for res in results],
+        )
+
+    if manifest is not None:
+        for res, job in zip(results, jobs):
+            if res["error"] is None and res["file"] in fps:
+                manifest.record(res["file"], *fps[res["file"]], res["tmat"], job[1:3])
+        manifest.save()
+
+    if all_rois_npz is not None:
+        tmats = dict()
+        if manifest is not None:
+            for file, (transform_fp, _) in fps.items():
+                tmat = manifest.transform(file, transform_fp)
+                if tmat is not None:
+                    tmats[file] = tmat
+        for res in results:
+            if res["error"] is None:
+                tmats[res["file"]] = res["tmat"]
+        files = [file for file in mov_img_file_list if file in tmats]
+        if len(files) > 0:
+            pipeline.export_rois(
+                ref_points,
+                [tmats[file] for file in files],
+                None,
+                roi_width,
+                shape=ref_img.shape,
+                npz_path=all_rois_npz,
+                names=[ut.base_name(file) for file in files],
+            )
+
+    failed = [res["file"] for res in results if res["error"] is not None]
+    if len(failed) > 0:
+        print(f"{len(failed)} files failed:")
+        for file in failed:
+            print(f"  {file}")
+
+
+# needed so that worker processes can import this file without running it
+if __name__ == "__main__":
+    main()
 
 
 # to transform an image
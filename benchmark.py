@@ -0,0 +1,278 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 15:20:09
+# @Last Modified: 2026-10-17 15:20:09
+# ------------------------------------------------------------------------------ #
+# Benchmarks for reading .his files and the alignment, on synthetic stacks.
+#
+# python benchmark.py --frames 2000 --output bench.json
+# python benchmark.py --frames 2000 --baseline bench.json
+#
+# The second call compares against the first and exits with 1 if any
+# benchmark got slower by more than --tolerance. Files are read from the
+# page cache after the first repeat, so these are warm-cache numbers.
+# ------------------------------------------------------------------------------ #
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import contextlib
+import tempfile
+import tracemalloc
+import numpy as np
+
+import utility as ut
+import pipeline
+import registration
+import synthetic_his
+from his_opener import HisOpener
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark his_stackreg")
+    parser.add_argument("--dir", default=None, help="where to write the test stacks")
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--pixel-type", default="uint16", choices=["uint8", "uint16"])
+    parser.add_argument(
+        "--bad-frames",
+        type=int,
+        default=3,
+        help="number of frames with inconsistent header size",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rois", type=int, default=5000)
+    parser.add_argument(
+        "--only", nargs="*", default=None, help="names of benchmarks to run"
+    )
+    parser.add_argument("--output", default=None, help="save results as json")
+    parser.add_argument("--baseline", default=None, help="json to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown that counts as regression",
+    )
+    return parser.parse_args(argv)
+
+
+def measure(func, repeat=3):
+    """
+        Runs `func` `repeat` times (and once more to find the peak memory
+        with tracemalloc, which slows down allocations and is therefore
+        not timed). `func` returns a dict with the bytes and frames it
+        processed. Messages printed by `func` are discarded.
+
+        Returns a dict with the median wall time, throughput and peak memory.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            work = func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    seconds = float(np.median(times))
+    res = dict(seconds=seconds, best=float(np.min(times)), peak_mb=peak / 1024 ** 2)
+    if work.get("bytes", 0) > 0:
+        res["mb_per_s"] = work["bytes"] / 1024 ** 2 / seconds
+    if work.get("frames", 0) > 0:
+        res["frames_per_s"] = work["frames"] / seconds
+    return res
+
+
+def create_stacks(args, work_dir):
+    """
+        A consistent and an inconsistent stack of the same scene, and a
+        moved version of the scene to register
+    """
+    img = synthetic_his.scene(args.width, args.height)
+    mov = synthetic_his.moved_scene(img, shift=(25, -40), rotation=1.5)
+
+    paths = dict()
+    rng = np.random.default_rng(42)
+    for name, num_bad in [("consistent", 0), ("inconsistent", args.bad_frames)]:
+        bad = rng.choice(np.arange(1, args.frames), size=num_bad, replace=False)
+        paths[name] = os.path.join(work_dir, f"bench_{name}.his")
+        synthetic_his.write_his(
+            paths[name],
+            synthetic_his.noisy_frames(img, args.frames, args.pixel_type),
+            num_frames=args.frames,
+            bad_offsets={int(b): 128 for b in bad},
+        )
+    return paths, img, mov
+
+
+def benchmarks(args, paths, ref_img, mov_img, work_dir):
+    """
+        Dict of name -> function to time
+    """
+    path = paths["consistent"]
+    bad_path = paths["inconsistent"]
+    his = HisOpener(path, use_index_cache=False)
+    frame_bytes = his.img_size
+    num_frames = his.num_frames
+    rng = np.random.default_rng(42)
+    random_frames = rng.choice(num_frames, size=min(200, num_frames), replace=False)
+
+    def open_cold():
+        h = HisOpener(path, skip_consistency_check=True, use_index_cache=False)
+        del h
+        return dict()
+
+    def open_indexed():
+        h = HisOpener(path, index_dir=work_dir)
+        del h
+        return dict()
+
+    def check_consistency():
+        h = HisOpener(bad_path, skip_consistency_check=True, use_index_cache=False)
+        h.check_consistency()
+        return dict(frames=num_frames)
+
+    def check_consistency_slow():
+        h = HisOpener(bad_path, skip_consistency_check=True, use_index_cache=False)
+        h.check_consistency_slow()
+        return dict(frames=num_frames, bytes=os.path.getsize(bad_path))
+
+    def read_frame():
+        for frame in random_frames:
+            his.read_frame(frame)
+        return dict(frames=len(random_frames), bytes=len(random_frames) * frame_bytes)
+
+    def read_frame_stack():
+        frames = np.arange(0, num_frames, max(1, num_frames // 200))
+        his.read_frame_stack(frames)
+        return dict(frames=len(frames), bytes=len(frames) * frame_bytes)
+
+    def read_frame_average():
+        his.read_frame_average(num_frames, func=np.nanmax)
+        return dict(frames=num_frames, bytes=num_frames * frame_bytes)
+
+    def stretch_contrast():
+        pipeline.stretch_contrast(mov_img)
+        return dict(frames=1, bytes=mov_img.nbytes)
+
+    ref = pipeline.stretch_contrast(ref_img)
+    mov = pipeline.stretch_contrast(mov_img)
+    template = registration.ReferenceTemplate(ref)
+
+    def register_stackreg():
+        pipeline.register(ref, mov, coarse_to_fine=False)
+        return dict(frames=1)
+
+    def register_coarse_to_fine():
+        template.register(mov)
+        return dict(frames=1)
+
+    points = np.vstack(
+        (
+            rng.uniform(0, args.width, args.rois),
+            rng.uniform(0, args.height, args.rois),
+            np.arange(args.rois),
+        )
+    ).T
+    tmat = registration.translation_matrix(-40, 25)
+    roi_path = os.path.join(work_dir, "bench_roi.csv")
+
+    def roi_export():
+        mov_points = pipeline.transform_points(points, tmat)
+        x, y, i = mov_points.T
+        ut.save_rois(fname=roi_path, roi_id=i, x=x, y=y, roi_width=10)
+        return dict(bytes=os.path.getsize(roi_path))
+
+    # the same rois for 20 sessions at once
+    tmats = [registration.translation_matrix(-40 + k, 25 - k) for k in range(20)]
+    batch_paths = [os.path.join(work_dir, f"bench_roi_{k}.csv") for k in range(20)]
+
+    def roi_export_batch():
+        pipeline.export_rois(points, tmats, batch_paths, 10, mov_img.shape)
+        return dict(bytes=sum([os.path.getsize(p) for p in batch_paths]))
+
+    return dict(
+        open_cold=open_cold,
+        open_indexed=open_indexed,
+        check_consistency=check_consistency,
+        check_consistency_slow=check_consistency_slow,
+        read_frame=read_frame,
+        read_frame_stack=read_frame_stack,
+        read_frame_average=read_frame_average,
+        stretch_contrast=stretch_contrast,
+        register_stackreg=register_stackreg,
+        register_coarse_to_fine=register_coarse_to_fine,
+        roi_export=roi_export,
+        roi_export_batch=roi_export_batch,
+    )
+
+
+def compare(results, baseline, tolerance):
+    """
+        Prints the change relative to `baseline` and returns the names of
+        benchmarks that got slower by more than `tolerance`. Compares the
+        best of the repeats, which is the least noisy.
+    """
+    regressions = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res["best"] / baseline[name]["best"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:>24}: {ratio:6.2f}x of baseline {flag}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        print(f"Writing {args.frames} frames of {args.width}x{args.height} ...")
+        paths, ref_img, mov_img = create_stacks(args, work_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            funcs = benchmarks(args, paths, ref_img, mov_img, work_dir)
+
+        results = dict()
+        for name, func in funcs.items():
+            if args.only is not None and name not in args.only:
+                continue
+            res = measure(func, args.repeat)
+            results[name] = res
+            line = f"{name:>24}: {res['seconds'] * 1000:9.1f} ms"
+            if "mb_per_s" in res:
+                line += f" {res['mb_per_s']:9.1f} MB/s"
+            if "frames_per_s" in res:
+                line += f" {res['frames_per_s']:9.1f} frames/s"
+            line += f"  peak {res['peak_mb']:.1f} MB"
+            print(line)
+
+    config = vars(args).copy()
+    for key in ["dir", "output", "baseline", "only"]:
+        config.pop(key)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(config=config, results=results), f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print("Warning: baseline was run with different settings")
+        if len(compare(results, baseline["results"], args.tolerance)) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 18:41:09
+# @Last Modified: 2026-10-17 18:41:09
+# ------------------------------------------------------------------------------ #
+# Catalog of all .his files in acquisition folders: size, shape, number of
+# frames and meta data, without opening every file with HisOpener.
+#
+# Only the header and meta data at the start of each file are read, for many
+# files at once (threads, as this is waiting for the disk or network share).
+# The catalog is kept as json lines file (one file per line) and a refresh only
+# reads files that are new or changed.
+# ------------------------------------------------------------------------------ #
+
+import os
+import json
+import concurrent.futures
+
+from his_opener import HEAD_OFFSET, parse_header, parse_meta_data
+
+# meta data is usually shorter, longer meta data needs a second read
+_FIRST_READ_BYTES = 64 * 1024
+
+
+def read_header(file_path):
+    """
+        The header fields of a .his file from (usually) a single read.
+        The meta data is kept as string, see Catalog.meta_data.
+
+        Returns:
+            dict with file, size, mtime_ns, width, height, pixel_type,
+            num_frames, base_offset, meta_data_str, and error (None or a
+            message if the file could not be read)
+    """
+    file_path = os.path.abspath(os.path.expanduser(file_path))
+    stat = os.stat(file_path)
+    entry = dict(file=file_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    try:
+        with open(file_path, "rb") as f:
+            buf = f.read(_FIRST_READ_BYTES)
+            header = parse_header(buf)
+            end = HEAD_OFFSET + header["base_offset"]
+            if end > len(buf):
+                buf += f.read(end - len(buf))
+        assert buf[0:2] == b"IM", "Not a .his file"
+        entry.update(header)
+        entry["pixel_type"] = "uint8" if header["pixel_size"] == 1 else "uint16"
+        # I guess utf-8 works
+        entry["meta_data_str"] = buf[HEAD_OFFSET:end].decode("utf-8", "replace")
+        entry["error"] = None
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+    return entry
+
+
+class Catalog:
+    """
+        Index of .his files, stored as json lines in `index_path`.
+
+        Example:
+            .. code-block:: python
+                catalog = Catalog("~/testdir/catalog.jsonl")
+                catalog.scan("~/testdir/")  # only reads new or changed files
+                for entry in catalog.select(width=1024, Exposure="50 ms"):
+                    print(entry["file"], entry["num_frames"])
+            ..
+    """
+
+    def __init__(self, index_path):
+        self.index_path = os.path.expanduser(index_path)
+        self.entries = dict()  # file -> entry
+        self._meta_data = dict()  # file -> parsed meta data
+        try:
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    if line.strip() != "":
+                        entry = json.loads(line)
+                        self.entries[entry["file"]] = entry
+        except FileNotFoundError:
+            pass
+
+    def scan(
+        self, folders, extensions=(".his",), recursive=False, num_threads=16, save=True
+    ):
+        """
+            Adds new and changed files (by size and modification time) in
+            `folders` to the catalog and removes files that no longer exist
+            in them.
+
+            Returns:
+                list of the files that were (re)read
+        """
+        if isinstance(folders, str):
+            folders = [folders]
+        extensions = tuple([e.lower() for e in extensions])
+
+        found = dict()  # file -> stat
+        for folder in folders:
+            folder = os.path.abspath(os.path.expanduser(folder))
+            for root, dirs, names in os.walk(folder):
+                for name in names:
+                    if not name.lower().endswith(extensions):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        found[path] = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                if not recursive:
+                    break
+            for path in list(self.entries.keys()):
+                in_folder = os.path.dirname(path) == folder or (
+                    recursive and path.startswith(os.path.join(folder, ""))
+                )
+                if in_folder and path not in found:
+                    self._remove(path)
+
+        changed = []
+        for path, stat in found.items():
+            entry = self.entries.get(path)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime_ns"] != stat.st_mtime_ns
+            ):
+                changed.append(path)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as ex:
+            for path, entry in zip(changed, ex.map(self._read, changed)):
+                if entry is None:
+                    # removed meanwhile
+                    self._remove(path)
+                    continue
+                self._meta_data.pop(path, None)
+                self.entries[path] = entry
+
+        if save:
+            self.save()
+        return sorted(changed)
+
+    @staticmethod
+    def _read(path):
+        try:
+            return read_header(path)
+        except FileNotFoundError:
+            return None
+
+    def _remove(self, path):
+        self.entries.pop(path, None)
+        self._meta_data.pop(path, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        # write to temp file first, so others never see half a catalog
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            for path in sorted(self.entries.keys()):
+                f.write(json.dumps(self.entries[path]) + "\n")
+        os.replace(tmp_path, self.index_path)
+
+    def meta_data(self, file_path):
+        """
+            The meta data of a file as dict, parsed on first access
+        """
+        path = os.path.abspath(os.path.expanduser(file_path))
+        if path not in self._meta_data:
+            entry = self.entries[path]
+            try:
+                self._meta_data[path] = parse_meta_data(entry["meta_data_str"])
+            except (KeyError, AttributeError):
+                # unreadable file or no meta data
+                self._meta_data[path] = dict()
+        return self._meta_data[path]
+
+    def select(self, **conditions):
+        """
+            All entries (sorted by file) where every condition holds.
+            Conditions are header fields (e.g. width=1024) or meta data fields.
+            Values can be functions, e.g. num_frames=lambda n: n > 1000.
+            Files that could not be read are skipped.
+        """
+        res = []
+        for path in sorted(self.entries.keys()):
+            entry = self.entries[path]
+            if entry["error"] is not None:
+                continue
+            ok = True
+            for key, value in conditions.items():
+                if key in entry:
+                    field = entry[key]
+                else:
+                    field = self.meta_data(path).get(key)
+                if callable(value):
+                    ok = field is not None and value(field)
+                else:
+                    ok = field == value
+                if not ok:
+                    break
+            if ok:
+                res.append(entry)
+        return res
+
+    def table(self, columns=("file", "size", "width", "height", "num_frames")):
+        """
+            List of rows (one tuple per readable file) with the requested
+            header or meta data fields, None where a field is missing.
+        """
+        rows = []
+        for entry in self.select():
+            meta_data = self.meta_data(entry["file"])
+            rows.append(tuple([entry.get(col, meta_data.get(col)) for col in columns]))
+        return rows
@@ -0,0 +1,239 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 16:55:12
+# @Last Modified: 2026-10-17 16:55:12
+# ------------------------------------------------------------------------------ #
+# Converts .his stacks to a folder of plain .npy chunks, for analyses that
+# read the same stack many times.
+#
+# The store has no frame headers, so there is nothing to parse or check:
+# every read is a slice of a memory mapped chunk. Chunks are
+# frames * rows * cols, e.g. (256, 1024, 1024) for fast access to whole
+# frames or (4096, 64, 64) for fast access to all frames of a small region.
+#
+# Layout:
+#   store_dir/manifest.json  shape, dtype, chunk shape, meta data, source file
+#   store_dir/c_{t}_{r}_{c}.npy  chunk t (along frames), r (rows), c (cols)
+# ------------------------------------------------------------------------------ #
+
+import os
+import json
+import numpy as np
+
+import reduction
+from his_opener import HisOpener, bin_frames
+from projection_cache import file_identity
+
+MANIFEST = "manifest.json"
+
+
+def _chunk_name(t, r, c):
+    return f"c_{t}_{r}_{c}.npy"
+
+
+def convert(
+    his, store_dir, chunks=(256, None, None), overwrite=False, memory_budget=None
+):
+    """
+        Streams a .his file into a chunked store. The chunks are memory mapped
+        .npy files, filled with as many frames at a time as fit into
+        `memory_budget`, so long chunks along the frames (e.g. 4096) do not
+        have to fit in memory.
+
+        Parameters:
+            his : HisOpener or path to a .his file
+            store_dir : folder to create
+            chunks : (frames, rows, cols) per chunk, None for the full size
+            overwrite : if False and the store exists, nothing is done
+            memory_budget : bytes for the frames read at once.
+                Default reduction.DEFAULT_MEMORY_BUDGET
+
+        Returns:
+            ChunkedStack of the new store
+    """
+    if not isinstance(his, HisOpener):
+        his = HisOpener(his)
+    if os.path.exists(os.path.join(store_dir, MANIFEST)) and not overwrite:
+        return ChunkedStack(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    shape = (his.num_frames, his.height, his.width)
+    chunks = [s if c is None else int(min(c, s)) for c, s in zip(chunks, shape)]
+    ct, cr, cc = chunks
+    if memory_budget is None:
+        memory_budget = reduction.DEFAULT_MEMORY_BUDGET
+    frame_bytes = his.height * his.width * np.dtype(his.pixel_type).itemsize
+    batch_size = int(max(1, memory_budget // frame_bytes))
+
+    for t, start in enumerate(range(0, shape[0], ct)):
+        stop = min(start + ct, shape[0])
+        tiles = dict()
+        for r, row in enumerate(range(0, shape[1], cr)):
+            for c, col in enumerate(range(0, shape[2], cc)):
+                tile_shape = (
+                    stop - start,
+                    min(cr, shape[1] - row),
+                    min(cc, shape[2] - col),
+                )
+                tiles[(r, c, row, col)] = np.lib.format.open_memmap(
+                    os.path.join(store_dir, _chunk_name(t, r, c)),
+                    mode="w+",
+                    dtype=his.pixel_type,
+                    shape=tile_shape,
+                )
+        for batch in range(start, stop, batch_size):
+            frames = np.arange(batch, min(batch + batch_size, stop))
+            stack = his.read_frame_stack(frames)
+            for (r, c, row, col), tile in tiles.items():
+                tile[batch - start : batch - start + len(frames)] = stack[
+                    :, row : row + cr, col : col + cc
+                ]
+            del stack
+        for tile in tiles.values():
+            tile.flush()
+        del tiles
+
+    manifest = dict(
+        version=1,
+        shape=shape,
+        dtype=np.dtype(his.pixel_type).name,
+        chunks=chunks,
+        meta_data=his.meta_data,
+        source=file_identity(his.file_path),
+    )
+    # the manifest is written last, so a store without one is incomplete
+    tmp_path = os.path.join(store_dir, f"{MANIFEST}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(store_dir, MANIFEST))
+    return ChunkedStack(store_dir)
+
+
+class ChunkedStack:
+    """
+        Reads a store created by `convert`, with the same methods as HisOpener
+        (read_frame, read_frame_stack, read_frame_average, ...).
+        Frames are returned as read-only views into the memory mapped chunks
+        whenever they lie within one chunk, copies otherwise.
+
+        Example:
+            .. code-block:: python
+                stack = convert("~/testdir/testfile.HIS", "~/testdir/testfile.chunks")
+                # later, no header parsing or consistency check needed
+                stack = ChunkedStack("~/testdir/testfile.chunks")
+                img = stack.read_frame_average(1000)
+            ..
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.expanduser(store_dir)
+        with open(os.path.join(self.store_dir, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        self.num_frames, self.height, self.width = manifest["shape"]
+        self.chunks = tuple(manifest["chunks"])
+        self.pixel_type = manifest["dtype"]
+        self.pixel_size = np.dtype(self.pixel_type).itemsize
+        self.meta_data = manifest["meta_data"]
+        self.source = manifest["source"]
+        self.file_path = self.source[0]
+        self.is_consistent = True
+        self.stats = None  # for the methods shared with HisOpener
+        self._mm = dict()
+
+    # these only depend on the shape (and read_frame_stack)
+    frame_shape = HisOpener.frame_shape
+    _roi_bounds = HisOpener._roi_bounds
+    frames_for_average = HisOpener.frames_for_average
+    read_frame_average = HisOpener.read_frame_average
+    read_frame_projections = HisOpener.read_frame_projections
+
+    def is_up_to_date(self):
+        """
+            True if the .his file that the store was created from did not change
+        """
+        try:
+            return file_identity(self.file_path) == self.source
+        except FileNotFoundError:
+            return False
+
+    def _chunk(self, t, r, c):
+        key = (t, r, c)
+        if key not in self._mm:
+            path = os.path.join(self.store_dir, _chunk_name(*key))
+            self._mm[key] = np.load(path, mmap_mode="r")
+        return self._mm[key]
+
+    def _read_block(self, frames, row_start, row_stop, col_start, col_stop):
+        """
+            Sorted, unique `frames` of the given region. A view if everything
+            lies in one chunk.
+        """
+        ct, cr, cc = self.chunks
+        t_ids = frames // ct
+        r_ids = range(row_start // cr, (row_stop - 1) // cr + 1)
+        c_ids = range(col_start // cc, (col_stop - 1) // cc + 1)
+
+        if t_ids[0] == t_ids[-1] and len(r_ids) == 1 and len(c_ids) == 1:
+            local = frames - t_ids[0] * ct
+            if len(local) == 1 or np.all(np.diff(local) == local[1] - local[0]):
+                # evenly spaced, slicing gives a view
+                step = 1 if len(local) == 1 else int(local[1] - local[0])
+                local = slice(int(local[0]), int(local[-1]) + 1, step)
+            chunk = self._chunk(t_ids[0], r_ids[0], c_ids[0])
+            r0 = r_ids[0] * cr
+            c0 = c_ids[0] * cc
+            return chunk[
+                local, row_start - r0 : row_stop - r0, col_start - c0 : col_stop - c0
+            ]
+
+        stack = np.empty(
+            shape=(len(frames), row_stop - row_start, col_stop - col_start),
+            dtype=self.pixel_type,
+        )
+        for t in np.unique(t_ids):
+            sel = np.where(t_ids == t)[0]
+            local = frames[sel] - t * ct
+            for r in r_ids:
+                # overlap of the chunk with the region, in frame coordinates
+                r_lo = max(row_start, r * cr)
+                r_hi = min(row_stop, (r + 1) * cr)
+                for c in c_ids:
+                    c_lo = max(col_start, c * cc)
+                    c_hi = min(col_stop, (c + 1) * cc)
+                    chunk = self._chunk(t, r, c)
+                    stack[
+                        sel[0] : sel[-1] + 1,
+                        r_lo - row_start : r_hi - row_start,
+                        c_lo - col_start : c_hi - col_start,
+                    ] = chunk[
+                        local,
+                        r_lo - r * cr : r_hi - r * cr,
+                        c_lo - c * cc : c_hi - c * cc,
+                    ]
+        return stack
+
+    def read_frame(self, frame, roi=None, binning=1):
+        """
+            The frame at the provided index, height * width.
+            For `roi` and `binning` see HisOpener.read_frame
+        """
+        return self.read_frame_stack(np.array([frame]), roi=roi, binning=binning)[0]
+
+    def read_frame_stack(self, frames, num_threads=None, roi=None, binning=1):
+        """
+            Multiple frames as 3d array frame_number * height * width.
+            `frames` can be an array of indices or a slice. `num_threads` is
+            ignored, there is nothing to parse.
+            For `roi` and `binning` see HisOpener.read_frame
+        """
+        bounds = self._roi_bounds(roi, binning)
+        if isinstance(frames, slice):
+            frames = np.arange(self.num_frames)[frames]
+        frames = np.asarray(frames)
+        assert (frames >= 0).all() and (frames < self.num_frames).all()
+        unique, inverse = np.unique(frames, return_inverse=True)
+        stack = bin_frames(self._read_block(unique, *bounds), binning)
+        if len(unique) == len(frames) and np.all(unique == frames):
+            return stack
+        return stack[inverse.ravel()]
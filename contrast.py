@@ -0,0 +1,107 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 19:02:47
+# @Last Modified: 2026-10-17 19:02:47
+# ------------------------------------------------------------------------------ #
+# Contrast stretching without sorting or float64 copies of the image.
+#
+# For uint8 and uint16 images, the exact percentiles follow from a histogram
+# (one bincount) and any per-pixel mapping is done with a lookup table over all
+# possible values. The table is computed with the same function as before
+# (e.g. skimage's rescale_intensity), so results are identical.
+# Other dtypes take the old way.
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+from skimage import exposure
+
+# pixels per np.take call, limits the temporary index array
+_BLOCK_SIZE = 256 * 1024
+
+
+def has_lut(img):
+    """
+        True if the image has few enough possible values for a lookup table
+    """
+    return img.dtype in [np.uint8, np.uint16]
+
+
+def histogram(img):
+    """
+        Counts of every possible value of a uint8 or uint16 image
+    """
+    # bincount converts to int64, so do it in blocks
+    flat = img.reshape(-1)
+    hist = np.zeros(np.iinfo(img.dtype).max + 1, dtype=np.int64)
+    for start in range(0, len(flat), _BLOCK_SIZE):
+        hist += np.bincount(flat[start : start + _BLOCK_SIZE], minlength=len(hist))
+    return hist
+
+
+def percentiles(img, q, hist=None):
+    """
+        Same as np.percentile(img, q) (linear interpolation), but in linear
+        time from the histogram for uint8 and uint16 images.
+    """
+    if not has_lut(img):
+        return np.percentile(img, q)
+    if hist is None:
+        hist = histogram(img)
+    cumsum = np.cumsum(hist)
+    num = int(cumsum[-1])
+    # as numpy: virtual index, its neighbours and the weight in between
+    virtual = (num - 1) * (np.asarray(q, dtype=np.float64) / 100)
+    prev = np.floor(virtual)
+    gamma = virtual - prev
+    prev = prev.astype(np.int64)
+    next = np.minimum(prev + 1, num - 1)
+    # value at sorted position k: the first value with more than k smaller ones
+    a = np.searchsorted(cumsum, prev, side="right").astype(np.float64)
+    b = np.searchsorted(cumsum, next, side="right").astype(np.float64)
+    diff = b - a
+    res = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return res[()] if res.ndim == 0 else res
+
+
+def lookup_table(dtype, func):
+    """
+        `func` applied to every possible value of the (uint8 or uint16) dtype
+    """
+    info = np.iinfo(dtype)
+    return func(np.arange(info.min, info.max + 1, dtype=dtype))
+
+
+def apply_lut(img, table, out=None):
+    """
+        table[img], in blocks so the temporary indices stay small.
+        `out` can be `img` itself if the table has the same dtype.
+    """
+    if out is None:
+        out = np.empty(img.shape, dtype=table.dtype)
+    flat_img = img.reshape(-1)
+    flat_out = out.reshape(-1)
+    for start in range(0, len(flat_img), _BLOCK_SIZE):
+        sl = slice(start, start + _BLOCK_SIZE)
+        np.take(table, flat_img[sl], out=flat_out[sl])
+    return out
+
+
+def stretch(img, low=2, high=98, out=None):
+    """
+        Rescales the `low` - `high` percentile range to the full range of the
+        dtype, as exposure.rescale_intensity(img, in_range=(p_low, p_high)).
+        For uint8/uint16 via histogram and lookup table, `out` may be `img`
+        to stretch in place.
+    """
+    in_range = tuple(percentiles(img, (low, high)))
+    if not has_lut(img):
+        res = exposure.rescale_intensity(img, in_range=in_range)
+        if out is None:
+            return res
+        out[:] = res
+        return out
+    table = lookup_table(
+        img.dtype, lambda values: exposure.rescale_intensity(values, in_range=in_range)
+    )
+    return apply_lut(img, table, out=out)
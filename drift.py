@@ -0,0 +1,145 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 17:24:40
+# @Last Modified: 2026-10-17 17:24:40
+# ------------------------------------------------------------------------------ #
+# Drift within a stack. Long recordings slowly move, so a single transform
+# per stack is not enough to keep the rois on their cells.
+#
+# The stack is split into (possibly overlapping) windows of frames. Each window
+# gets its own small projection and is registered to the reference, starting
+# from the transform of the previous window. All windows are filled in one
+# pass over the file.
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+
+import reduction
+import registration
+import pipeline
+from his_opener import HisOpener
+
+
+def windows(num_frames, window_size=1000, step=None):
+    """
+        (start, stop) of every window. Windows are `window_size` frames long
+        and start every `step` frames (default: window_size, no overlap).
+        The last window ends at the last frame.
+    """
+    window_size = int(min(window_size, num_frames))
+    step = window_size if step is None else int(step)
+    starts = list(range(0, num_frames - window_size + 1, step))
+    if starts[-1] + window_size < num_frames:
+        starts.append(num_frames - window_size)
+    return np.array([(s, s + window_size) for s in starts], dtype=np.int64)
+
+
+def track_drift(
+    his,
+    ref,
+    ref_points=None,
+    window_size=1000,
+    step=None,
+    frames_per_window=50,
+    func="max",
+    init=None,
+    memory_budget=None,
+):
+    """
+        Transforms of all windows of a stack to the reference.
+
+        Parameters:
+            his : HisOpener (or ChunkedStack) or path to a .his file
+            ref : registration.ReferenceTemplate or the (stretched) reference image
+            ref_points : rois on the reference, columns col, row, id. If given,
+                the rois are moved for every window.
+            window_size, step : see windows()
+            frames_per_window : the projection of every window uses this many
+                frames, spread evenly over the window
+            func : projection, see reduction.reducer_name
+            init : tmat to start the first window from, e.g. the transform of
+                the whole stack. None to start with a coarse estimate.
+            memory_budget : bytes for the frames read at once
+
+        Returns:
+            dict with
+            windows : (start, stop) of every window
+            frames : center frame of every window
+            tmats : window_number * 3 * 3 transformation matrices
+            points : window_number * roi_number * 3, the moved rois
+                (only if ref_points are given)
+    """
+    if isinstance(his, str):
+        his = HisOpener(his)
+    if not isinstance(ref, registration.ReferenceTemplate):
+        ref = registration.ReferenceTemplate(ref)
+    if memory_budget is None:
+        memory_budget = reduction.DEFAULT_MEMORY_BUDGET
+
+    wins = windows(his.num_frames, window_size, step)
+    stride = max(1, (wins[0, 1] - wins[0, 0]) // frames_per_window)
+    frames = np.unique(
+        np.concatenate([np.arange(start, stop, stride) for start, stop in wins])
+    )
+
+    shape = his.frame_shape()
+    frame_bytes = int(np.prod(shape)) * np.dtype(his.pixel_type).itemsize
+    chunk_size = int(max(1, memory_budget // frame_bytes))
+    name = reduction.reducer_name(func)
+
+    tmats = np.zeros((len(wins), 3, 3))
+    reducers = dict()
+    done = 0
+    tmat = init
+    center = np.array([(shape[1] - 1) / 2, (shape[0] - 1) / 2, 1.0])
+
+    def finish(idx):
+        nonlocal tmat
+        img = reducers.pop(idx).result().astype(his.pixel_type)
+        seed = None
+        if tmat is not None:
+            # only pass on where the center went. passing on the rotation,
+            # too, lets small errors in the rotation of the (blurry) window
+            # projections add up over many windows.
+            shift = tmat @ center - center
+            seed = registration.translation_matrix(shift[0], shift[1])
+        tmat = ref.register(pipeline.stretch_contrast(img), init=seed)
+        tmats[idx] = tmat
+
+    for start in range(0, len(frames), chunk_size):
+        chunk_frames = frames[start : start + chunk_size]
+        chunk = his.read_frame_stack(chunk_frames)
+        # fold the chunk into every window it overlaps
+        for idx in range(done, len(wins)):
+            lo, hi = wins[idx]
+            if lo > chunk_frames[-1]:
+                break
+            sel = (chunk_frames >= lo) & (chunk_frames < hi)
+            if not np.any(sel):
+                continue
+            if idx not in reducers:
+                reducers[idx] = reduction.create_reducer(name, shape, his.pixel_type)
+            reducers[idx].update(chunk[sel])
+        del chunk
+        # windows that end before the next chunk are complete
+        next_frame = (
+            frames[start + chunk_size] if start + chunk_size < len(frames) else None
+        )
+        while done < len(wins) and (next_frame is None or wins[done, 1] <= next_frame):
+            finish(done)
+            done += 1
+
+    res = dict(windows=wins, frames=wins.mean(axis=1), tmats=tmats)
+    if ref_points is not None:
+        res["points"] = np.array(
+            [pipeline.transform_points(ref_points, t) for t in tmats]
+        )
+    return res
+
+
+def save_drift(fname, res):
+    """
+        Saves the result of track_drift as .npz
+    """
+    np.savez(fname, **res)
@@ -2,14 +2,74 @@
 # @Author:        F. Paul Spitzner
 # @Email:         paul.spitzner@ds.mpg.de
 # @Created:       2020-01-17 15:42:14
-# @Last Modified: 2020-02-06 14:06:13
+# @Last Modified: 2026-10-17 10:12:40
 # ------------------------------------------------------------------------------ #
 
 import struct
 import re
 import os
+import json
+import hashlib
+import threading
+import concurrent.futures
 import numpy as np
 
+import reduction
+from instrumentation import staged
+
+
+def bin_frames(img, binning):
+    """
+        Averages blocks of `binning` * `binning` pixels along the last two axes,
+        works for single frames and stacks. The dtype is kept.
+    """
+    if binning == 1:
+        return img
+    height = img.shape[-2] // binning
+    width = img.shape[-1] // binning
+    img = img[..., : height * binning, : width * binning]
+    shape = img.shape[:-2] + (height, binning, width, binning)
+    binned = img.reshape(shape).mean(axis=(-3, -1), dtype=np.float32)
+    if np.issubdtype(img.dtype, np.integer):
+        np.rint(binned, out=binned)
+    return binned.astype(img.dtype)
+
+
+# size of the propriatery header in front of every frame
+HEAD_OFFSET = 64
+# up to four buffers per frame in a single os.preadv, below the usual IOV_MAX
+_MAX_FRAMES_PER_READ = 256
+
+
+def parse_header(head):
+    """
+        Fields of the header of the first frame, from its first (at least 18) bytes.
+
+        Returns:
+            dict with base_offset (size of the meta data after the first
+            header), width, height, pixel_size (bytes) and num_frames
+    """
+    return dict(
+        base_offset=struct.unpack_from("<h", head, 2)[0],
+        width=struct.unpack_from("<h", head, 4)[0],
+        height=struct.unpack_from("<h", head, 6)[0],
+        pixel_size=struct.unpack_from("<h", head, 12)[0],
+        num_frames=struct.unpack_from("<I", head, 14)[0],
+    )
+
+
+def parse_meta_data(meta_data_str):
+    """
+        The `key=value` pairs between `@Hokawo@` and `~Hokawo~` as dict
+    """
+    meta_data = dict()
+    tmp = re.search("@Hokawo@(.*)~Hokawo~", meta_data_str).group(1)
+    for pair in tmp.split(";"):
+        sp = pair.split("=")
+        if len(sp) > 1:
+            meta_data[sp[0]] = sp[1]
+    return meta_data
+
 
 class HisOpener:
     """
@@ -31,6 +91,20 @@ class HisOpener:
             file_path :
             pixel_size : size of each pixel, in bytes
             pixel_type : e.g. 'uint8'
+            use_memmap : if True, frames are returned as views into a memory map
+                of the file instead of being read (and copied) frame by frame
+            num_threads : number of threads that read frames concurrently in
+                read_frame_stack. Reads are positional (os.preadv) and do not share
+                a file position, on systems without preadv (Windows) they
+                are serialized and only decoding is concurrent.
+            use_index_cache : if True, lookup tables, the consistency check result
+                and meta data are stored in an index file next to the .his file
+                (or in index_dir, or ~/.cache/his_stackreg if that is not writable)
+                and reused when the same file is opened again
+            stats : an instrumentation.Stats to collect timings of the consistency
+                checks, reads and projections, and the bytes and number of reads
+                from the file (reads through the memory map are not counted).
+                None (default) to skip all bookkeeping.
 
         Example:
             .. code-block:: python
@@ -52,36 +126,30 @@ class HisOpener:
 
     """
 
-    def __init__(self, file_path, skip_consistency_check=False):
+    def __init__(
+        self,
+        file_path,
+        skip_consistency_check=False,
+        use_memmap=False,
+        use_index_cache=True,
+        index_dir=None,
+        num_threads=1,
+        stats=None,
+    ):
         file_path = os.path.expanduser(file_path)
         # print(f"Opening .his file: {file_path}")
         f = open(file_path, "rb")
 
         # proprietary header
-        f.seek(2)
-        base_offset = struct.unpack("<h", f.read(2))[0]
-        f.seek(4)
-        width = struct.unpack("<h", f.read(2))[0]
-        f.seek(6)
-        height = struct.unpack("<h", f.read(2))[0]
-        f.seek(12)
-        pixel_size = struct.unpack("<h", f.read(2))[0]
-        f.seek(14)
-        num_frames = struct.unpack("<I", f.read(4))[0]
+        header = parse_header(f.read(18))
+        base_offset = header["base_offset"]
+        width = header["width"]
+        height = header["height"]
+        pixel_size = header["pixel_size"]
+        num_frames = header["num_frames"]
 
         # size of the propriatery header
-        head_offset = 64
-
-        # meta data
-        f.seek(head_offset)
-        meta_data = dict()
-        # I guess utf-8 works
-        meta_data_str = f.read(base_offset).decode("utf-8")
-        tmp = re.search("@Hokawo@(.*)~Hokawo~", meta_data_str).group(1)
-        for pair in tmp.split(";"):
-            sp = pair.split("=")
-            if len(sp) > 1:
-                meta_data[sp[0]] = sp[1]
+        head_offset = HEAD_OFFSET
 
         # image size (actual pixels) in bytes
         img_size = width * height * pixel_size
@@ -89,7 +157,7 @@ class HisOpener:
         # first frame at pos 0 has different size, let's get the offset for all the others
         f.seek(base_offset + head_offset + img_size)
         # header begins after a check string "IM"
-        check_string = f.read(2).decode("utf-8")
+        check_string = f.read(2)
         # the short after the check string contains the offset to the next frame's header
         frame_offset = struct.unpack("<h", f.read(2))[0]
 
@@ -109,16 +177,36 @@ class HisOpener:
         else:
             self.pixel_type = "uint16"
 
-        # self.meta_data_str = meta_data_str
-        self.meta_data = meta_data
         self.f_is_open = True
         self.is_consistent = None
-        if not skip_consistency_check:
-            self.check_consistency()
-
+        self.is_checked_thoroughly = False
         self.lookup_pos = None  # positions for f seek
         self.lookup_offset = None  # header size
 
+        self.num_threads = num_threads
+        self.stats = stats
+        # frames closer than this are fetched with one read, see plan_reads
+        self.max_gap_bytes = 2 * 1024 ** 2
+        self.max_read_bytes = 64 * 1024 ** 2
+        self._lock = threading.Lock()  # for seek + read without preadv
+
+        self.use_memmap = use_memmap
+        self._mm = None  # raw bytes of the whole file
+        self._mm_stack = None  # strided view, frame_number * height * width
+
+        self.use_index_cache = use_index_cache
+        self.index_dir = index_dir
+        if not use_index_cache or not self.load_index():
+            # meta data
+            f.seek(head_offset)
+            # I guess utf-8 works
+            meta_data_str = f.read(base_offset).decode("utf-8")
+            # self.meta_data_str = meta_data_str
+            self.meta_data = parse_meta_data(meta_data_str)
+
+        if not skip_consistency_check and self.is_consistent is None:
+            self.check_consistency()
+
     def get_frame_pos(self, i):
         """
             Helper function to get the position of a frame to supply to f.seek.
@@ -140,46 +228,118 @@ class HisOpener:
         else:
             raise ValueError
 
-    def check_consistency_slow(self):
+    @staged("check_consistency_slow")
+    def check_consistency_slow(self, block_size=65536):
         """
             Goes through all frames in the stack and checks the meta data size length.
             Creates a lookup table, so frames can be accessed even if meta data
             size varies.
 
-            Takes about 10sec to check a 45GB file, loaded from SSD
+            Frame headers are read through the memory map, in blocks:
+            assuming the header size stays the same, all positions of a block
+            are computed at once and only the frames where the size
+            changes need to be located one by one. After every change, blocks
+            start small and double up to `block_size`, so frequent changes
+            do not read the same headers over and over.
         """
-        print(f"Thorough check of {self.file_path}")
-        if self.is_consistent is not None:
+        if self.is_checked_thoroughly:
             return
+        print(f"Thorough check of {self.file_path}")
+        mm = self.memmap()
+        num_frames = self.num_frames
         head_offset = self.head_offset
-        old_offset = self.base_offset
         img_size = self.img_size
+        marker = np.frombuffer(b"IM", dtype=np.uint8)
 
-        lookup_pos = np.ones((self.num_frames), dtype=np.int64) * -1
-        lookup_offset = np.ones((self.num_frames), dtype=np.int16) * -1
+        lookup_pos = np.ones((num_frames), dtype=np.int64) * -1
+        lookup_offset = np.ones((num_frames), dtype=np.int16) * -1
         inconsistent = 0
-        pos = 0
 
-        for i in range(0, self.num_frames):
-            lookup_pos[i] = pos
-            lookup_offset[i] = old_offset
-            self.f.seek(pos)
-            check_string = self.f.read(2).decode("utf-8")
-            new_offset = struct.unpack("<h", self.f.read(2))[0]
-            pos = pos + new_offset + head_offset + img_size
-            if (i > 1 and i < self.num_frames - 1) and (
-                check_string != "IM" or new_offset != old_offset
-            ):
+        def read_headers(pos):
+            # "IM" check and offset for every position, False if past the end
+            valid = pos + 4 <= len(mm)
+            hdr = mm[pos[valid][:, np.newaxis] + np.arange(4)]
+            is_good = np.zeros(len(pos), dtype=bool)
+            offsets = np.zeros(len(pos), dtype=np.int16)
+            is_good[valid] = np.all(hdr[:, 0:2] == marker, axis=1)
+            offsets[valid] = np.ascontiguousarray(hdr[:, 2:4]).view("<i2")[:, 0]
+            return is_good, offsets
+
+        # the first frame carries the meta data, its header size is base_offset
+        is_good, offsets = read_headers(np.array([0], dtype=np.int64))
+        assert is_good[0]
+        lookup_pos[0] = 0
+        lookup_offset[0] = offsets[0]
+
+        # position and offset of the last frame with known location
+        last = 0
+        while last < num_frames - 1:
+            first = last + 1
+            pos_first = (
+                int(lookup_pos[last])
+                + head_offset
+                + int(lookup_offset[last])
+                + img_size
+            )
+            header = bytes(mm[pos_first : pos_first + 4])
+            if header[0:2] != b"IM":
+                print(f"  No frame header found for frame {first}, file truncated?")
+                inconsistent += 1
+                break
+            offset = struct.unpack("<h", header[2:4])[0]
+            if first > 1 and offset != lookup_offset[last]:
                 inconsistent += 1
                 print(
-                    f"  Offset inconsistency at frame {i-1} -> {i}: "
-                    + f"{old_offset} -> {new_offset}"
+                    f"  Offset inconsistency at frame {last} -> {first}: "
+                    + f"{lookup_offset[last]} -> {offset}"
                 )
-            old_offset = new_offset
+
+            # assume all following frames have the same header size,
+            # blockwise until one does not
+            stride = head_offset + offset + img_size
+            lookup_pos[first] = pos_first
+            lookup_offset[first] = offset
+            last = first
+            start = first + 1
+            size = 1
+            while start < num_frames:
+                if size == 1:
+                    # offsets that change often are cheaper to follow frame by frame
+                    pos = pos_first + (start - first) * stride
+                    header = bytes(mm[pos : pos + 4])
+                    if header[0:2] != b"IM" or header[2:4] != struct.pack("<h", offset):
+                        break
+                    lookup_pos[start] = pos
+                    lookup_offset[start] = offset
+                    last = start
+                    start += 1
+                    size = 2
+                    continue
+                idx = np.arange(start, min(num_frames, start + size))
+                pos = pos_first + (idx - first) * np.int64(stride)
+                is_good, offsets = read_headers(pos)
+                is_good &= offsets == offset
+                num_good = len(idx) if is_good.all() else int(np.argmin(is_good))
+                lookup_pos[idx[:num_good]] = pos[:num_good]
+                lookup_offset[idx[:num_good]] = offset
+                last = start + num_good - 1
+                if num_good < len(idx):
+                    # position of the first bad frame is still correct, since
+                    # the previous one had the right size
+                    break
+                start += len(idx)
+                size = min(2 * size, block_size)
+
         self.is_consistent = inconsistent == 0
+        self.is_checked_thoroughly = True
         self.lookup_pos = lookup_pos
+        self.lookup_offset = lookup_offset
         print(f"inconsistent {inconsistent}")
+        self._mm_stack = None
+        if self.use_index_cache:
+            self.save_index()
 
+    @staged("check_consistency")
     def check_consistency(self):
         """
             Goes through some frames in the stack and checks the meta data size length.
@@ -200,10 +360,9 @@ class HisOpener:
         inconsistent = 0
 
         # take care of first frame
-        self.f.seek(0)
-        check_string = self.f.read(2).decode("utf-8")
-        assert check_string == "IM"
-        old_offset = struct.unpack("<h", self.f.read(2))[0]
+        header = self._read_at(0, 4)
+        assert header[0:2] == b"IM"
+        old_offset = struct.unpack("<h", header[2:4])[0]
         lookup_pos[0] = 0
         lookup_offset[0] = old_offset
 
@@ -220,15 +379,14 @@ class HisOpener:
                     frame_id = num_frames - 1
                     jump = num_frames - last_good_frame_id
 
-                old_offset = lookup_offset[last_good_frame_id]
-                pos = lookup_pos[last_good_frame_id]
+                old_offset = int(lookup_offset[last_good_frame_id])
+                pos = int(lookup_pos[last_good_frame_id])
                 pos = pos + jump * (old_offset + head_offset + img_size)
 
-                self.f.seek(pos)
-                check_string = self.f.read(2).decode("utf-8")
-                if check_string == "IM":
+                header = self._read_at(pos, 4)
+                if header[0:2] == b"IM":
                     frame_is_good = True
-                    new_offset = struct.unpack("<h", self.f.read(2))[0]
+                    new_offset = struct.unpack("<h", header[2:4])[0]
                     if new_offset != old_offset and last_good_frame_id > 0:
                         inconsistent += 1
                         print(
@@ -236,6 +394,13 @@ class HisOpener:
                             + f"{old_offset} -> {new_offset}"
                         )
                     break
+                elif jump == 1:
+                    # the next frame always starts right after the last good one,
+                    # so an earlier "IM" was found in image data, the file is
+                    # broken or it ends here (still being written?).
+                    # the thorough check finds every frame that is there.
+                    print(f"  Frame {frame_id} not found at byte {pos}")
+                    return self.check_consistency_slow()
                 else:
                     jump = int(np.fmax(1, jump / 2))
             lookup_pos[frame_id] = pos
@@ -245,87 +410,629 @@ class HisOpener:
                 done = True
 
         # fill all remaining entries in the lookup tables
+        # every frame takes offset and position from the last checked one before it
         checked = np.where(lookup_offset != -1)[0]
-        for idx in range(1, len(checked)):
-            start = checked[idx - 1]
-            stop = checked[idx]
-            offset = lookup_offset[start]
-            lookup_offset[start:stop] = offset
-            last_pos = lookup_pos[start]
-            for j in range(start, stop):
-                lookup_pos[j] = last_pos + np.int64(j - start) * (
-                    offset + head_offset + img_size
-                )
+        frame_ids = np.arange(num_frames)
+        start = checked[np.searchsorted(checked, frame_ids, side="right") - 1]
+        lookup_offset = lookup_offset[start]
+        lookup_pos = lookup_pos[start] + (frame_ids - start) * (
+            lookup_offset.astype(np.int64) + head_offset + img_size
+        )
 
         self.is_consistent = inconsistent == 0
         self.lookup_offset = lookup_offset
         self.lookup_pos = lookup_pos
+        self._mm_stack = None
+        if self.use_index_cache:
+            self.save_index()
+
+    def index_paths(self):
+        """
+            Candidate locations of the index file, in order of preference.
+            Next to the .his file or, if index_dir was given, only there.
+            Falls back to the user cache directory for read-only shares.
+        """
+        abs_path = os.path.abspath(self.file_path)
+        name = os.path.basename(abs_path)
+        hashed = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()[:16]
+        hashed = f"{name}.{hashed}.idx.npz"
+        if self.index_dir is not None:
+            return [os.path.join(os.path.expanduser(self.index_dir), hashed)]
+        user_cache = os.path.join(os.path.expanduser("~"), ".cache", "his_stackreg")
+        return [f"{abs_path}.idx.npz", os.path.join(user_cache, hashed)]
+
+    def _index_key(self):
+        """
+            Identifies the file content the index belongs to: path, size and mtime
+        """
+        stat = os.stat(self.file_path)
+        return os.path.abspath(self.file_path), stat.st_size, stat.st_mtime_ns
+
+    def save_index(self):
+        """
+            Writes lookup tables, consistency and meta data to the index file.
+            Returns the path that was written or None if no location was writable.
+        """
+        path, size, mtime = self._index_key()
+        dat = dict(
+            file_path=np.array(path),
+            file_size=np.array(size, dtype=np.int64),
+            file_mtime=np.array(mtime, dtype=np.int64),
+            is_consistent=np.array(
+                -1 if self.is_consistent is None else int(self.is_consistent)
+            ),
+            is_checked_thoroughly=np.array(self.is_checked_thoroughly),
+            meta_data=np.array(json.dumps(self.meta_data)),
+        )
+        if self.lookup_pos is not None:
+            dat["lookup_pos"] = self.lookup_pos
+        if self.lookup_offset is not None:
+            dat["lookup_offset"] = self.lookup_offset
+
+        for index_path in self.index_paths():
+            try:
+                os.makedirs(os.path.dirname(index_path), exist_ok=True)
+                # write to temp file first so readers never see half an index
+                tmp_path = f"{index_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as tmp:
+                    np.savez(tmp, **dat)
+                os.replace(tmp_path, index_path)
+                return index_path
+            except OSError:
+                continue
+        return None
+
+    def load_index(self):
+        """
+            Loads lookup tables, consistency and meta data from the index file,
+            if one exists that matches the current path, size and mtime of
+            the .his file. Stale indices are ignored (and overwritten on the
+            next check). Returns True if an index was loaded.
+        """
+        path, size, mtime = self._index_key()
+        for index_path in self.index_paths():
+            try:
+                with np.load(index_path, allow_pickle=False) as dat:
+                    if (
+                        str(dat["file_path"]) != path
+                        or int(dat["file_size"]) != size
+                        or int(dat["file_mtime"]) != mtime
+                    ):
+                        continue
+                    is_consistent = int(dat["is_consistent"])
+                    self.is_consistent = (
+                        None if is_consistent == -1 else bool(is_consistent)
+                    )
+                    self.is_checked_thoroughly = bool(dat["is_checked_thoroughly"])
+                    self.meta_data = json.loads(str(dat["meta_data"]))
+                    if "lookup_pos" in dat:
+                        self.lookup_pos = dat["lookup_pos"]
+                    if "lookup_offset" in dat:
+                        self.lookup_offset = dat["lookup_offset"]
+                    return True
+            except Exception:
+                # missing, unreadable or corrupt index, try the next one
+                continue
+        return False
+
+    def memmap(self):
+        """
+            Maps the whole file (read only) and returns it as 1d array of bytes.
+            Nothing is read from disk until the pages are accessed.
+        """
+        if self._mm is None:
+            self._mm = np.memmap(self.file_path, dtype=np.uint8, mode="r")
+        return self._mm
+
+    def memmap_stack(self):
+        """
+            Returns a 3d view frame_number * height * width into the memory map
+            that skips the frame headers. No data is read or copied.
+
+            Only works if all frames after the first have the same header size,
+            because the first frame carries the meta data, the image data of
+            all frames are then evenly spaced. Raises a ValueError if the stack
+            is known to be inconsistent, use memmap_frame() for single frames then.
+        """
+        if self.is_consistent == False:
+            raise ValueError("Stack is inconsistent, cannot create a strided view")
+        if self._mm_stack is not None:
+            return self._mm_stack
+
+        mm = self.memmap()
+        start = self.head_offset + self.base_offset
+        stride = self.head_offset + self.frame_offset + self.img_size
+        num_frames = self.num_frames
+        if len(mm) < start + self.img_size:
+            num_frames = 0
+        elif num_frames > 1:
+            num_frames = min(
+                num_frames, (len(mm) - start - self.img_size) // stride + 1
+            )
+        if num_frames < self.num_frames:
+            print(
+                f"  {self.file_path} is truncated, "
+                + f"only {num_frames}/{self.num_frames} frames are mapped"
+            )
+
+        self._mm_stack = np.ndarray(
+            shape=(num_frames, self.height, self.width),
+            dtype=self.pixel_type,
+            buffer=mm,
+            offset=start,
+            strides=(stride, self.width * self.pixel_size, self.pixel_size),
+        )
+        return self._mm_stack
+
+    def memmap_frame(self, frame):
+        """
+            Returns a 2d view height * width into the memory map for a single frame,
+            located via the lookup table (if available) and the frame header.
+            Works for inconsistent stacks, too.
+        """
+        mm = self.memmap()
+        pos = self.get_frame_pos(frame)
+        if mm[pos : pos + 2].tobytes() != b"IM":
+            raise IndexError
+        offset = int(mm[pos + 2 : pos + 4].view("<i2")[0])
+        pos = int(pos + offset + self.head_offset)
+        img = mm[pos : pos + self.img_size].view(self.pixel_type)
+        return img.reshape((self.height, self.width))
+
+    def _memmap_check_frames(self, frames):
+        """
+            Checks the "IM" header strings of the provided frames as positioned by
+            the strided view. Raises an IndexError if the (assumed) layout is off.
+        """
+        if self.lookup_pos is not None or len(frames) == 0:
+            return
+        mm = self.memmap()
+        frames = np.asarray(frames, dtype=np.int64)
+        pos = (self.head_offset + self.base_offset) + frames * (
+            self.head_offset + self.frame_offset + self.img_size
+        )
+        # headers before the image data, first frame starts at 0
+        pos = np.where(frames == 0, 0, pos - self.head_offset - self.frame_offset)
+        if np.any(pos + 2 > len(mm)):
+            raise IndexError
+        marker = mm[pos[:, np.newaxis] + np.arange(2)]
+        if not np.all(marker == np.frombuffer(b"IM", dtype=np.uint8)):
+            raise IndexError
+
+    def _memmap_read_frame_stack(self, frames):
+        """
+            Returns the frames from the memory map. Slices (and evenly spaced
+            index arrays) give a view, other index arrays need a single copy.
+        """
+        if self.is_consistent == False:
+            if isinstance(frames, slice):
+                frames = np.arange(self.num_frames)[frames]
+            return np.stack([self.memmap_frame(i) for i in frames])
+
+        stack = self.memmap_stack()
+        if not isinstance(frames, slice):
+            frames = np.asarray(frames, dtype=np.int64)
+            steps = np.diff(frames)
+            if len(frames) > 0 and (
+                len(frames) == 1 or (steps[0] > 0 and np.all(steps == steps[0]))
+            ):
+                step = int(steps[0]) if len(frames) > 1 else 1
+                frames = slice(int(frames[0]), int(frames[-1]) + 1, step)
+        if isinstance(frames, slice):
+            self._memmap_check_frames(np.arange(len(stack))[frames])
+        else:
+            self._memmap_check_frames(frames)
+        return stack[frames]
 
     # in case you dont want to keep the buffer open all the time
     def close_file(self):
         self.f.close()
         self.f_is_open = False
+        self._mm_stack = None
+        self._mm = None
 
     def reopen_file(self):
         self.f = open(self.file_path, "rb")
         self.f_is_open = True
 
-    def read_frame(self, frame):
+    def _read_into(self, pos, buffers):
         """
-            Reads the frame at the provided index into a 2d numpy array
+            Reads from file position `pos` into a list of writable buffers,
+            filling one after the other. Returns the number of bytes read.
+
+            Uses positional reads that do not move the shared file position,
+            so this can be called from many threads at once. Where os.preadv is
+            not available (Windows) falls back to seek + read under a lock.
         """
         if not self.f_is_open:
             self.reopen_file()
+        if hasattr(os, "preadv"):
+            num_bytes = os.preadv(self.f.fileno(), buffers, pos)
+            if self.stats is not None:
+                self.stats.count_read(num_bytes)
+            return num_bytes
+        num_bytes = 0
+        with self._lock:
+            self.f.seek(pos)
+            for buf in buffers:
+                n = self.f.readinto(buf)
+                num_bytes += n
+                if n < memoryview(buf).nbytes:
+                    break
+        if self.stats is not None:
+            self.stats.count_read(num_bytes, reads=len(buffers), seeks=1)
+        return num_bytes
 
-        pos = self.get_frame_pos(frame)
-        self.f.seek(pos)
-        check_string = self.f.read(2).decode("utf-8")
-        if check_string != "IM":
+    def _read_at(self, pos, size):
+        """
+            Positional read of `size` bytes, fewer at the end of the file
+        """
+        buf = bytearray(size)
+        num_bytes = self._read_into(pos, [buf])
+        return bytes(buf[:num_bytes])
+
+    def _read_frame_into(self, frame, out, rows=None):
+        """
+            Reads the image data of a frame into `out`, a c-contiguous array
+            height * width. Header and image are fetched with a single read
+            when the header size is known from the lookup table (or consistency).
+
+            With `rows=(start, stop)` only these rows are read and `out` has to
+            be (stop - start) * width. Then the header is read separately.
+        """
+        pos = int(self.get_frame_pos(frame))
+        if pos < 0:
+            # not found by check_consistency_slow, file is truncated
+            raise IndexError
+        if self.lookup_offset is not None:
+            offset = int(self.lookup_offset[frame])
+        else:
+            offset = self.base_offset if frame == 0 else self.frame_offset
+
+        data = memoryview(out).cast("B")
+        skip = 0 if rows is None else rows[0] * self.width * self.pixel_size
+        if skip == 0:
+            header = bytearray(self.head_offset + offset)
+            num_bytes = self._read_into(pos, [header, data])
+        else:
+            header = bytearray(4)
+            num_bytes = self._read_into(pos, [header])
+        if num_bytes < 4 or header[0:2] != b"IM":
             # print("Invalid frame found. Run check_consistency to create the lookup table.")
             raise IndexError
-        offset = struct.unpack("<h", self.f.read(2))[0]
-        pos = int(pos + offset + self.head_offset)
-        self.f.seek(pos)
-        img = np.frombuffer(self.f.read(self.img_size), dtype=self.pixel_type)
-        return img.reshape((self.width, self.height))
+        actual_offset = struct.unpack("<h", header[2:4])[0]
+        if skip > 0 or actual_offset != offset:
+            # header size was not what we expected, read again at the right spot
+            pos = pos + self.head_offset + actual_offset + skip
+            num_bytes = len(header) + self._read_into(pos, [data])
+        if num_bytes < len(header) + data.nbytes:
+            raise IndexError
 
-    def read_frame_stack(self, frames):
+    def _frame_windows(self, frames, rows=None):
+        """
+            File positions of the headers of `frames`, their expected header
+            sizes and where the image data (or only the `rows`) begins and ends
+        """
+        frames = np.asarray(frames)
+        if self.lookup_pos is not None:
+            pos = self.lookup_pos[frames]
+        else:
+            pos = np.array([self.get_frame_pos(i) for i in frames], dtype=np.int64)
+        if self.lookup_offset is not None:
+            offset = self.lookup_offset[frames].astype(np.int64)
+        else:
+            offset = np.where(frames == 0, self.base_offset, self.frame_offset)
+        begin = pos + self.head_offset + offset
+        size = self.img_size
+        if rows is not None:
+            begin = begin + rows[0] * self.width * self.pixel_size
+            size = (rows[1] - rows[0]) * self.width * self.pixel_size
+        return pos, offset, begin, begin + size
+
+    def _max_gap(self, rows=None, max_gap_bytes=None):
+        """
+            Largest number of unneeded bytes read to save a separate read.
+            For a few rows, no more than the rows themselves.
+        """
+        if max_gap_bytes is None:
+            max_gap_bytes = self.max_gap_bytes
+        if rows is None:
+            return max_gap_bytes
+        return min(max_gap_bytes, (rows[1] - rows[0]) * self.width * self.pixel_size)
+
+    def plan_reads(self, frames, max_gap_bytes=None, max_read_bytes=None, rows=None):
+        """
+            Groups frames into contiguous reads, to replace many small reads
+            (and seeks) by a few large ones.
+
+            Parameters:
+                frames : sorted array of unique frame indices
+                max_gap_bytes : frames are merged into one read if no more than
+                    this many bytes lie between them. Default `self.max_gap_bytes`
+                max_read_bytes : upper limit for the size of a single read.
+                    Default `self.max_read_bytes`
+                rows : (start, stop) if only these rows of every frame are read.
+                    Then the gaps are between the row windows and frames are
+                    only merged if the gap is not larger than the window.
+
+            Returns:
+                list of index arrays into `frames`, one per read
+        """
+        if max_read_bytes is None:
+            max_read_bytes = self.max_read_bytes
+        max_gap_bytes = self._max_gap(rows, max_gap_bytes)
+        frames = np.asarray(frames)
+        if len(frames) == 0:
+            return []
+        pos, offset, begin, stop = self._frame_windows(frames, rows)
+
+        groups = []
+        first = 0
+        for idx in range(1, len(frames)):
+            gap = begin[idx] - stop[idx - 1]
+            size = stop[idx] - pos[first]
+            if (
+                gap > max_gap_bytes
+                or size > max_read_bytes
+                or idx - first >= _MAX_FRAMES_PER_READ
+            ):
+                groups.append(np.arange(first, idx))
+                first = idx
+        groups.append(np.arange(first, len(frames)))
+        return groups
+
+    def _read_group_into(self, frames, stack, rows=None):
+        """
+            Reads consecutive frames with a single read, straight into `stack`
+            (every frame, or only the `rows`). Headers and whatever lies
+            between the frames go to small scratch buffers.
+        """
+        if len(frames) == 1:
+            return self._read_frame_into(frames[0], stack[0], rows)
+
+        pos, offset, begin, stop = self._frame_windows(frames, rows)
+        headers = [bytearray(4) for _ in frames]
+        # for a few rows deep in the frame, the first header is read on its own
+        start = int(pos[0])
+        if begin[0] - pos[0] - 4 > self._max_gap(rows):
+            self._read_into(start, [headers[0]])
+            start = int(begin[0])
+        # gaps are not needed, so they can all share one buffer
+        scratch_size = max(np.max(begin[1:] - stop[:-1]), begin[0] - start)
+        scratch = memoryview(bytearray(int(scratch_size)))
+
+        buffers = []
+        if start == pos[0]:
+            buffers += [headers[0], scratch[: int(begin[0] - pos[0] - 4)]]
+        for idx in range(len(frames)):
+            if idx > 0:
+                buffers.append(scratch[: int(pos[idx] - stop[idx - 1])])
+                buffers.append(headers[idx])
+                buffers.append(scratch[: int(begin[idx] - pos[idx] - 4)])
+            buffers.append(memoryview(stack[idx]).cast("B"))
+        num_bytes = self._read_into(start, [b for b in buffers if len(b) > 0])
+
+        for idx, i in enumerate(frames):
+            if num_bytes < stop[idx] - start:
+                # short read, end of file (or a broken file)
+                self._read_frame_into(i, stack[idx], rows)
+                continue
+            header = headers[idx]
+            if header[0:2] != b"IM":
+                raise IndexError
+            if struct.unpack("<h", header[2:4])[0] != offset[idx]:
+                # header was not the size we expected, read on its own
+                self._read_frame_into(i, stack[idx], rows)
+
+    def _read_frames_into(self, frames, stack, num_threads=1, rows=None):
+        """
+            Reads sorted, unique `frames` into `stack`, following plan_reads
+        """
+        if self.lookup_pos is not None and np.any(self.lookup_pos[frames] < 0):
+            raise IndexError
+        groups = self.plan_reads(frames, rows=rows)
+        tasks = [
+            (frames[group], stack[group[0] : group[-1] + 1], rows) for group in groups
+        ]
+        if num_threads > 1 and len(tasks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+                # list() to raise exceptions from the threads here
+                list(executor.map(lambda task: self._read_group_into(*task), tasks))
+        else:
+            for task in tasks:
+                self._read_group_into(*task)
+
+    def frame_shape(self, roi=None, binning=1):
+        """
+            Shape of the frames returned for the region of interest `roi`
+            and binning factor `binning`, see read_frame
+        """
+        row_start, row_stop, col_start, col_stop = self._roi_bounds(roi, binning)
+        return ((row_stop - row_start) // binning, (col_stop - col_start) // binning)
+
+    def _roi_bounds(self, roi, binning=1):
+        """
+            row_start, row_stop, col_start, col_stop of the `roi` clipped to the
+            frame and cropped so that the size is a multiple of `binning`
+        """
+        if roi is None:
+            roi = (0, self.height, 0, self.width)
+        row_start, row_stop, col_start, col_stop = [int(x) for x in roi]
+        row_start, row_stop = np.clip([row_start, row_stop], 0, self.height)
+        col_start, col_stop = np.clip([col_start, col_stop], 0, self.width)
+        assert row_stop > row_start and col_stop > col_start, "Empty roi"
+        row_stop -= (row_stop - row_start) % binning
+        col_stop -= (col_stop - col_start) % binning
+        return int(row_start), int(row_stop), int(col_start), int(col_stop)
+
+    @staged("read")
+    def read_frame(self, frame, roi=None, binning=1):
+        """
+            Reads the frame at the provided index into a 2d numpy array
+            height * width. With use_memmap, this is a read-only view.
+
+            roi : region of interest (row_start, row_stop, col_start, col_stop),
+                only the rows in the roi are read from disk
+            binning : average over `binning` * `binning` pixel blocks,
+                e.g. 2 or 4. Sizes that are not a multiple are cropped
+        """
+        row_start, row_stop, col_start, col_stop = self._roi_bounds(roi, binning)
+        if self.use_memmap:
+            if self.is_consistent == False:
+                img = self.memmap_frame(frame)
+            else:
+                self._memmap_check_frames([frame])
+                img = self.memmap_stack()[frame]
+            img = img[row_start:row_stop, col_start:col_stop]
+            return bin_frames(img, binning)
+
+        img = np.empty(shape=(row_stop - row_start, self.width), dtype=self.pixel_type)
+        if row_stop - row_start == self.height:
+            self._read_frame_into(frame, img)
+        else:
+            self._read_frame_into(frame, img, rows=(row_start, row_stop))
+        img = img[:, col_start:col_stop]
+        return bin_frames(img, binning)
+
+    @staged("read")
+    def read_frame_stack(self, frames, num_threads=None, roi=None, binning=1):
         """
             Reads multiple frames from file and returns a 3d numpy array
-            frame_number * width * height
+            frame_number * height * width
+
+            frames can be an array of indices or a slice. With use_memmap,
+            slices and evenly spaced indices give a read-only view without copy.
+            Otherwise, frames are read by `num_threads` threads (default
+            from the constructor) directly into the preallocated stack.
+
+            Frames are read in file order (whatever order is requested) and
+            nearby frames are fetched with a single read, see plan_reads.
+
+            For `roi` and `binning` see read_frame.
         """
+        row_start, row_stop, col_start, col_stop = self._roi_bounds(roi, binning)
+        if self.use_memmap:
+            try:
+                stack = self._memmap_read_frame_stack(frames)
+            except IndexError:
+                self.check_consistency()
+                stack = self._memmap_read_frame_stack(frames)
+            stack = stack[:, row_start:row_stop, col_start:col_stop]
+            return bin_frames(stack, binning)
+
+        if isinstance(frames, slice):
+            frames = np.arange(self.num_frames)[frames]
+        if num_threads is None:
+            num_threads = self.num_threads
         if not self.f_is_open:
             self.reopen_file()
+        frames = np.asarray(frames)
         assert (frames >= 0).all() and (frames < self.num_frames).all()
+        unique, inverse = np.unique(frames, return_inverse=True)
         stack = np.empty(
-            shape=(len(frames), self.width, self.height), dtype=self.pixel_type
+            shape=(len(unique), row_stop - row_start, self.width),
+            dtype=self.pixel_type,
         )
+        rows = None
+        if row_stop - row_start < self.height:
+            rows = (row_start, row_stop)
 
-        for idx, i in enumerate(frames):
-            try:
-                stack[idx] = self.read_frame(i)
-            except IndexError:
-                self.check_consistency()
-                stack[idx] = self.read_frame(i)
+        try:
+            self._read_frames_into(unique, stack, num_threads, rows)
+        except IndexError:
+            self.check_consistency()
+            self._read_frames_into(unique, stack, num_threads, rows)
 
-        return stack
+        stack = bin_frames(stack[:, :, col_start:col_stop], binning)
+        if len(unique) == len(frames) and np.all(unique == frames):
+            return stack
+        return stack[inverse.ravel()]
 
-    def read_frame_average(self, frames=200, func=np.nanmax):
-        """
-            Reads some frames from across the file and computes the average
-            by using the provided funcion. defaul np.nanmax
+    def frames_for_average(self, frames=200, sampling="even", block_size=16):
         """
+            Indices of the frames to use for a projection. Either the provided
+            array or (if a number is given) that many frames from across the file.
 
+            sampling : "even" spreads single frames evenly from beginning to end,
+                "blocks" takes blocks of `block_size` consecutive frames that are
+                spread evenly. Both cover the whole recording, but blocks need
+                `block_size` times fewer seeks.
+        """
         try:
             assert not isinstance(frames, list)
             frames = float(frames)
-            incr = int(np.fmax(1, self.num_frames / frames))
-            frames = np.arange(0, self.num_frames, incr)
         except:
             assert isinstance(frames, np.ndarray)
+            return frames
+
+        if sampling == "even":
+            incr = int(np.fmax(1, self.num_frames / frames))
+            return np.arange(0, self.num_frames, incr)
+        elif sampling == "blocks":
+            block_size = int(min(block_size, frames, self.num_frames))
+            num_blocks = int(np.ceil(frames / block_size))
+            starts = np.linspace(0, self.num_frames - block_size, num_blocks)
+            frames = starts.astype(np.int64)[:, np.newaxis] + np.arange(block_size)
+            return np.unique(frames.ravel())
+        raise ValueError(f"Unknown sampling {sampling}")
+
+    @staged("projection")
+    def read_frame_average(
+        self,
+        frames=200,
+        func=np.nanmax,
+        memory_budget=None,
+        sampling="even",
+        roi=None,
+        binning=1,
+    ):
+        """
+            Reads some frames from across the file and computes the average
+            by using the provided funcion. defaul np.nanmax
 
-        stack = self.read_frame_stack(frames)
-        return func(stack, axis=0).astype(self.pixel_type)
+            For max, min, mean, var, std and median (as numpy functions or by name,
+            see reduction.reducer_name) the frames are streamed in chunks and
+            at most `memory_budget` bytes are used. The median is then
+            approximated from a random subset of frames, if not all fit.
+            Other functions get the full stack.
+            For `sampling` see frames_for_average, for `roi` and `binning`
+            see read_frame. Binning is done chunk by chunk.
+        """
+        frames = self.frames_for_average(frames, sampling)
+        if reduction.reducer_name(func) is None:
+            stack = self.read_frame_stack(frames, roi=roi, binning=binning)
+            return func(stack, axis=0).astype(self.pixel_type)
+
+        res = self.read_frame_projections(
+            frames, [func], memory_budget, roi=roi, binning=binning
+        )
+        return list(res.values())[0].astype(self.pixel_type)
+
+    @staged("projection")
+    def read_frame_projections(
+        self,
+        frames=200,
+        funcs=("max", "mean"),
+        memory_budget=None,
+        sampling="even",
+        roi=None,
+        binning=1,
+    ):
+        """
+            Computes several projections in one pass over the file, e.g.
+            `funcs=["max", "mean", "std", "p98"]`.
+            Returns a dict mapping the names to 2d arrays, see
+            reduction.stream_projections
+        """
+        frames = self.frames_for_average(frames, sampling)
+        return reduction.stream_projections(
+            self,
+            frames,
+            funcs=funcs,
+            memory_budget=memory_budget,
+            roi=roi,
+            binning=binning,
+        )
 
     # printed representation
     def __repr__(self):
@@ -339,4 +1046,6 @@ class HisOpener:
         return self is other
 
     def __del__(self):
-        self.f.close()
+        # f does not exist if opening failed
+        if hasattr(self, "f"):
+            self.f.close()
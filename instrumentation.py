@@ -0,0 +1,224 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 15:48:31
+# @Last Modified: 2026-10-17 15:48:31
+# ------------------------------------------------------------------------------ #
+# Timings and i/o counters per processing stage, to find out where a batch
+# spends its time (disk, consistency check, projection, registration, ...).
+#
+# Everything is opt-in: HisOpener and the pipeline take `stats=None` and then
+# skip all bookkeeping.
+# ------------------------------------------------------------------------------ #
+
+import json
+import functools
+import time
+import threading
+import contextlib
+import tracemalloc
+
+
+def _empty_record():
+    return dict(
+        calls=0, wall=0.0, cpu=0.0, bytes_read=0, reads=0, seeks=0, peak_bytes=0
+    )
+
+
+class Stats:
+    """
+        Collects wall time, cpu time and i/o counters for named stages.
+
+        Stages can be nested, i/o counted while a stage is active is added to
+        that stage (and all stages it is nested in) and to `totals`.
+        cpu time is that of the whole process, so it includes other threads
+        working at the same time.
+
+        Example:
+            .. code-block:: python
+                stats = Stats()
+                his = HisOpener(file_path, stats=stats)
+                with stats.stage("projection"):
+                    img = his.read_frame_average(1000)
+                print(stats.to_dict())
+            ..
+
+        Parameters:
+            hooks : list of functions hook(stage_name, record), called whenever a
+                stage ends. `record` is a dict with the numbers of this call.
+                Hooks are sent to worker processes, so they have to be defined
+                at module level.
+            trace_memory : if True, the peak memory allocated during every stage
+                is found with tracemalloc (this slows down python allocations,
+                numpy arrays are included).
+    """
+
+    def __init__(self, hooks=None, trace_memory=False):
+        self.hooks = [] if hooks is None else list(hooks)
+        self.trace_memory = trace_memory
+        self.stages = dict()
+        self.totals = _empty_record()
+        self._active = []
+        self._mem_start = dict()  # id of active record -> traced memory at start
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+            Context manager that times everything in it as stage `name`
+        """
+        record = _empty_record()
+        record["calls"] = 1
+        with self._lock:
+            if self.trace_memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                # the peak is reset for this stage, keep it for the others
+                self._fold_peak()
+                self._mem_start[id(record)] = tracemalloc.get_traced_memory()[0]
+                if hasattr(tracemalloc, "reset_peak"):
+                    tracemalloc.reset_peak()
+            self._active.append((name, record))
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - wall
+            record["cpu"] = time.process_time() - cpu
+            with self._lock:
+                if self.trace_memory:
+                    self._fold_peak()
+                    self._mem_start.pop(id(record))
+                self._active = [a for a in self._active if a[1] is not record]
+                self._add(name, record)
+            for hook in self.hooks:
+                hook(name, record)
+
+    def _fold_peak(self):
+        """
+            Updates the peak of every active stage with the peak traced since
+            the last reset (which was when the latest of them started)
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        for _, record in self._active:
+            mem_start = self._mem_start[id(record)]
+            record["peak_bytes"] = max(record["peak_bytes"], peak - mem_start)
+
+    def is_active(self, name):
+        return name in [n for n, _ in self._active]
+
+    def _add(self, name, record):
+        total = self.stages.setdefault(name, _empty_record())
+        for key, value in record.items():
+            if key == "peak_bytes":
+                total[key] = max(total[key], value)
+            else:
+                total[key] += value
+
+    def count_read(self, num_bytes, reads=1, seeks=0):
+        """
+            Adds one read (syscall) of `num_bytes` to the active stages
+        """
+        with self._lock:
+            for record in [r for _, r in self._active] + [self.totals]:
+                record["bytes_read"] += num_bytes
+                record["reads"] += reads
+                record["seeks"] += seeks
+
+    def merge(self, other):
+        """
+            Adds the stages and totals of another Stats (or its to_dict())
+        """
+        if isinstance(other, Stats):
+            other = other.to_dict()
+        with self._lock:
+            for name, record in other["stages"].items():
+                self._add(name, record)
+            for key, value in other["totals"].items():
+                if key == "peak_bytes":
+                    self.totals[key] = max(self.totals[key], value)
+                else:
+                    self.totals[key] += value
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                stages={k: dict(v) for k, v in self.stages.items()},
+                totals=dict(self.totals),
+            )
+
+
+def stage(stats, name):
+    """
+        stats.stage(name), or a context manager that does nothing if
+        `stats` is None
+    """
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
+
+
+def staged(name):
+    """
+        Decorator for methods of classes with a `stats` attribute (Stats or None):
+        the method is timed as stage `name`, unless a stage of that name
+        is already running (e.g. when the method calls itself or a method
+        with the same stage name).
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None or self.stats.is_active(name):
+                return method(self, *args, **kwargs)
+            with self.stats.stage(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_report(fname, results):
+    """
+        Writes the stats of a batch as json, one entry per file and the
+        sum over all files.
+
+        Parameters:
+            results : list of dicts with keys file, error and stats
+                (from Stats.to_dict()), as returned by pipeline.align_batch
+    """
+    total = Stats()
+    files = []
+    for res in results:
+        if res is None:
+            continue
+        if res.get("stats") is not None:
+            total.merge(res["stats"])
+        files.append(
+            dict(
+                file=res["file"],
+                failed=res["error"] is not None,
+                duration=res.get("duration"),
+                stats=res.get("stats"),
+            )
+        )
+    report = dict(files=files, total=total.to_dict())
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def print_summary(report):
+    """
+        Prints the time spent in every stage, summed over all files
+    """
+    stages = report["total"]["stages"]
+    print(f"{'stage':>16} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'MB read':>9}")
+    for name, rec in sorted(stages.items(), key=lambda x: -x[1]["wall"]):
+        print(
+            f"{name:>16} {rec['calls']:6d} {rec['wall']:9.2f} {rec['cpu']:9.2f} "
+            + f"{rec['bytes_read'] / 1024 ** 2:9.1f}"
+        )
@@ -0,0 +1,114 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 18:20:31
+# @Last Modified: 2026-10-17 18:20:31
+# ------------------------------------------------------------------------------ #
+# Remembers which inputs every output was created from, so that a rerun only
+# redoes the outputs whose inputs (stacks, rois, parameters) changed.
+#
+# Every entry holds two fingerprints: one of everything the transformation
+# depends on (stacks and projection/registration parameters) and one of
+# everything the output files depend on (the transformation, rois, roi_width).
+# If only the latter changed, the stored transformation is reused and only
+# the files are written again.
+# ------------------------------------------------------------------------------ #
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def file_hash(file_path, block_size=1024 ** 2):
+    """
+        sha1 of the content of a (small) file, e.g. the roi file
+    """
+    sha = hashlib.sha1()
+    with open(os.path.expanduser(file_path), "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint(**parts):
+    """
+        Hash of all keyword arguments (anything json can represent)
+    """
+    desc = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+
+class RunManifest:
+    """
+        A json file with one entry per input file (e.g. per stack that is
+        aligned): the fingerprints it was processed with, the resulting
+        transformation matrix and the output files.
+
+        Example:
+            .. code-block:: python
+                manifest = RunManifest("~/out/manifest.json")
+                if not manifest.is_current(file, transform_fp, output_fp):
+                    tmat = manifest.transform(file, transform_fp)
+                    # ... None: register again, otherwise only save outputs
+                    manifest.record(file, transform_fp, output_fp, tmat, [roi_path])
+                manifest.save()
+            ..
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.entries = dict()
+        try:
+            with open(self.path, "r") as f:
+                dat = json.load(f)
+            if dat.get("version") == self.version:
+                self.entries = dat["entries"]
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.abspath(os.path.expanduser(file_path))
+
+    def is_current(self, file_path, transform_fp, output_fp):
+        """
+            True if the outputs of `file_path` were created from the same
+            inputs and all of them still exist
+        """
+        entry = self.entries.get(self._key(file_path))
+        if entry is None:
+            return False
+        return (
+            entry["transform"] == transform_fp
+            and entry["output"] == output_fp
+            and all([os.path.exists(p) for p in entry["outputs"]])
+        )
+
+    def transform(self, file_path, transform_fp):
+        """
+            The stored transformation matrix, if it was found with the same
+            inputs. None otherwise.
+        """
+        entry = self.entries.get(self._key(file_path))
+        if entry is None or entry["transform"] != transform_fp:
+            return None
+        return np.array(entry["tmat"])
+
+    def record(self, file_path, transform_fp, output_fp, tmat, outputs):
+        self.entries[self._key(file_path)] = dict(
+            transform=transform_fp,
+            output=output_fp,
+            tmat=np.asarray(tmat).tolist(),
+            outputs=[os.path.abspath(p) for p in outputs],
+        )
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # write to temp file first, so an interrupted run keeps the old one
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(version=self.version, entries=self.entries), f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,592 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 11:20:37
+# @Last Modified: 2026-10-17 11:20:37
+# ------------------------------------------------------------------------------ #
+# The steps of align_his_stackreg.py as functions, so that they can be run
+# for many files in parallel worker processes.
+# ------------------------------------------------------------------------------ #
+
+import os
+import time
+import queue
+import threading
+import traceback
+import concurrent.futures
+import numpy as np
+
+from skimage import transform as tf
+from pystackreg import StackReg  # pip install pystackreg
+
+import utility as ut
+from his_opener import HisOpener
+from projection_cache import ProjectionCache
+import preview
+import contrast
+import registration
+import instrumentation
+from instrumentation import Stats, stage
+
+
+def load_image(
+    file_path,
+    use_average=True,
+    frames_for_average=1000,
+    frame_sampling="even",
+    cache=None,
+    stats=None,
+):
+    """
+        Loads the image to align from a .his file, either the average
+        over `frames_for_average` frames or only the first frame.
+        For `frame_sampling` see HisOpener.frames_for_average.
+        If a ProjectionCache is provided, the image is only computed if
+        it is not cached yet.
+        If an instrumentation.Stats is provided, the steps are timed.
+    """
+    if cache is not None:
+        with stage(stats, "cache"):
+            if use_average:
+                key = cache.key(
+                    file_path, frames_for_average, np.nanmax, sampling=frame_sampling
+                )
+            else:
+                key = cache.key(file_path, np.array([0]), "first")
+            img = cache.get(key)
+        if img is not None:
+            return img
+
+    with stage(stats, "open"):
+        his = HisOpener(file_path, skip_consistency_check=True, stats=stats)
+    if use_average:
+        img = his.read_frame_average(frames_for_average, sampling=frame_sampling)
+    else:
+        img = np.array(his.read_frame(0))
+    del his
+
+    if cache is not None:
+        with stage(stats, "cache"):
+            cache.put(key, img)
+    return img
+
+
+def stretch_contrast(img):
+    """
+        increase the image contrast. this improved the results from stackreg drastically
+        https://scikit-image.org/docs/dev/auto_examples/color_exposure/plot_equalize.html
+    """
+    # same as rescale_intensity(img, in_range=np.percentile(img, (2, 98))),
+    # without sorting for uint8 and uint16 images
+    return contrast.stretch(img, 2, 98)
+
+
+def register(ref_img, mov_img, coarse_to_fine=True, estimate_rotation=False):
+    """
+        find the transformation matrix
+        we only use rigid body, gives: x shift, y shift, rotation
+
+        with `coarse_to_fine`, stackreg starts from a phase correlation estimate
+        (see registration.register), which is needed for larger drifts.
+        `estimate_rotation` adds a coarse estimate of the rotation, too.
+        `ref_img` can also be a registration.ReferenceTemplate, then the
+        other options are taken from the template.
+    """
+    if isinstance(ref_img, registration.ReferenceTemplate):
+        return ref_img.register(mov_img)
+    if coarse_to_fine:
+        return registration.register(ref_img, mov_img, rotation=estimate_rotation)
+    sreg = StackReg(StackReg.RIGID_BODY)
+    return sreg.register(ref=ref_img, mov=mov_img)
+
+
+def transform_points(ref_points, tmat):
+    """
+        apply the matrix to the old ROIs
+        this is essentially just:
+        src = np.vstack((x, y, np.ones_like(x)))
+        dst = src.T @ matrix.T
+    """
+    mov_points = np.copy(ref_points)
+    mov_points[:, 0:2] = tf.matrix_transform(coords=ref_points[:, 0:2], matrix=tmat)
+    return mov_points
+
+
+def transform_points_batch(ref_points, tmats):
+    """
+        apply a stack of matrices (sessions * 3 * 3) to the same ROIs at once.
+        returns sessions * rois * 3, columns col, row, id as in ref_points
+    """
+    tmats = np.asarray(tmats, dtype=np.float64).reshape(-1, 3, 3)
+    src = np.ones((len(ref_points), 3))
+    src[:, 0:2] = ref_points[:, 0:2]
+    # sessions * rois * 3, as src @ tmat.T for every session
+    dst = np.matmul(src[np.newaxis], tmats.transpose(0, 2, 1))
+    mov_points = np.empty((len(tmats), len(ref_points), ref_points.shape[1]))
+    mov_points[:] = ref_points
+    mov_points[:, :, 0:2] = dst[:, :, 0:2] / dst[:, :, 2:3]
+    return mov_points
+
+
+def export_rois(
+    ref_points, tmats, roi_paths, roi_width, shape, npz_path=None, names=None,
+):
+    """
+        Moves the rois with every tmat and saves all of them, see
+        ut.save_rois_batch. `shape` (height, width) of the images is used
+        to flag rois that might be out of the image.
+        Returns the moved points, sessions * rois * 3
+    """
+    mov_points = transform_points_batch(ref_points, tmats)
+    ut.save_rois_batch(
+        roi_paths,
+        roi_id=ref_points[:, 2],
+        x=mov_points[:, :, 0],
+        y=mov_points[:, :, 1],
+        roi_width=roi_width,
+        img_width=shape[1],
+        img_height=shape[0],
+        npz_path=npz_path,
+        names=names,
+    )
+    return mov_points
+
+
+def align_image(
+    mov_img,
+    ref_img,
+    ref_points,
+    roi_path,
+    img_path=None,
+    roi_width=10,
+    thumbnail_factor=None,
+    coarse_to_fine=True,
+    estimate_rotation=False,
+    stats=None,
+    tmat=None,
+):
+    """
+        Aligns the (unstretched) `mov_img` to the (stretched) `ref_img`
+        (or a ReferenceTemplate of it),
+        saves the moved rois to `roi_path` and a preview to `img_path`.
+        Returns the transformation matrix and a thumbnail of the preview
+        (None, unless `thumbnail_factor` is given).
+        For `coarse_to_fine` and `estimate_rotation` see register().
+        If an instrumentation.Stats is provided, the steps are timed.
+        If a `tmat` is provided (e.g. from a previous run), the registration
+        is skipped and only the rois and preview are saved.
+    """
+    with stage(stats, "stretch"):
+        mov_img = stretch_contrast(mov_img)
+    if tmat is None:
+        with stage(stats, "register"):
+            tmat = register(ref_img, mov_img, coarse_to_fine, estimate_rotation)
+
+    # save in netcals image format. import via "load roi (legacy)"
+    with stage(stats, "save_rois"):
+        mov_points = transform_points(ref_points, tmat)
+        x, y, i = mov_points[:].T
+        ut.save_rois(
+            fname=roi_path,
+            roi_id=i,
+            x=x,
+            y=y,
+            roi_width=roi_width,
+            img_width=mov_img.shape[1],
+            img_height=mov_img.shape[0],
+        )
+
+    thumbnail = None
+    if img_path is not None:
+        with stage(stats, "preview"):
+            thumbnail = preview.save_preview(
+                img_path, mov_img, mov_points, roi_width, 2, thumbnail_factor
+            )
+
+    return tmat, thumbnail
+
+
+# ------------------------------------------------------------------------------ #
+# batch processing
+# ------------------------------------------------------------------------------ #
+
+# set once per worker process by _init_worker, so the reference image is
+# only sent to every worker once and not with every task
+_worker_ref = dict()
+
+
+def _init_worker(ref_img, ref_points, settings):
+    _worker_ref["ref_img"] = ref_img
+    _worker_ref["ref_points"] = ref_points
+    _worker_ref["settings"] = settings
+    _worker_ref["cache"] = None
+    if settings["projection_cache_dir"] is not None:
+        _worker_ref["cache"] = ProjectionCache(
+            settings["projection_cache_dir"], settings["projection_cache_bytes"]
+        )
+
+
+class RestartingPool:
+    """
+        A ProcessPoolExecutor that is replaced by a new one when a worker
+        process died (e.g. killed for lack of memory), so the remaining tasks
+        still run. Tasks that were running in the broken pool fail, their
+        futures raise BrokenProcessPool, see result_or_error.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.executor = concurrent.futures.ProcessPoolExecutor(**kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            return self.executor.submit(fn, *args, **kwargs)
+        except concurrent.futures.process.BrokenProcessPool:
+            print("A worker process died, starting new workers")
+            self.executor.shutdown(wait=False)
+            self.executor = concurrent.futures.ProcessPoolExecutor(**self.kwargs)
+            return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
+
+
+def result_or_error(future, on_error):
+    """
+        future.result(), or on_error(traceback) if the worker process running
+        the task died. Other errors are raised.
+    """
+    try:
+        return future.result()
+    except concurrent.futures.process.BrokenProcessPool:
+        return on_error(traceback.format_exc())
+
+
+def failed_result(idx, file, error, duration=0.0):
+    """
+        Result of a job that could not be aligned, as returned by _align_task
+    """
+    return dict(
+        idx=idx,
+        file=file,
+        tmat=None,
+        thumbnail=None,
+        error=error,
+        duration=duration,
+        stats=None,
+    )
+
+
+def make_settings(
+    roi_width=10,
+    use_average=True,
+    frames_for_average=1000,
+    frame_sampling="even",
+    projection_cache_dir=None,
+    projection_cache_bytes=5 * 1024 ** 3,
+    thumbnail_factor=None,
+    coarse_to_fine=True,
+    estimate_rotation=False,
+    instrument=False,
+    stats_hooks=None,
+    trace_memory=False,
+):
+    """
+        The settings that the workers need, for _init_worker.
+        For the parameters see align_batch.
+    """
+    return dict(
+        roi_width=roi_width,
+        use_average=use_average,
+        frames_for_average=frames_for_average,
+        frame_sampling=frame_sampling,
+        projection_cache_dir=projection_cache_dir,
+        projection_cache_bytes=projection_cache_bytes,
+        thumbnail_factor=thumbnail_factor,
+        coarse_to_fine=coarse_to_fine,
+        estimate_rotation=estimate_rotation,
+        instrument=instrument,
+        stats_hooks=stats_hooks,
+        trace_memory=trace_memory,
+    )
+
+
+def _new_stats():
+    settings = _worker_ref["settings"]
+    if not settings["instrument"]:
+        return None
+    return Stats(hooks=settings["stats_hooks"], trace_memory=settings["trace_memory"])
+
+
+def _load_task(mov_img_path, stats=None):
+    settings = _worker_ref["settings"]
+    return load_image(
+        mov_img_path,
+        use_average=settings["use_average"],
+        frames_for_average=settings["frames_for_average"],
+        frame_sampling=settings["frame_sampling"],
+        cache=_worker_ref["cache"],
+        stats=stats,
+    )
+
+
+def _align_task(idx, mov_img_path, roi_path, img_path, tmat=None, mov_img=None):
+    """
+        Processes one file in a worker. Errors are caught and returned,
+        so a bad file does not stop the others. If no (prefetched) `mov_img`
+        is provided, it is loaded first. A known `tmat` skips the registration.
+    """
+    start = time.perf_counter()
+    stats = _new_stats()
+    try:
+        if mov_img is None:
+            mov_img = _load_task(mov_img_path, stats)
+        tmat, thumbnail = align_image(
+            mov_img,
+            _worker_ref["ref_img"],
+            _worker_ref["ref_points"],
+            roi_path=roi_path,
+            img_path=img_path,
+            roi_width=_worker_ref["settings"]["roi_width"],
+            thumbnail_factor=_worker_ref["settings"]["thumbnail_factor"],
+            coarse_to_fine=_worker_ref["settings"]["coarse_to_fine"],
+            estimate_rotation=_worker_ref["settings"]["estimate_rotation"],
+            stats=stats,
+            tmat=tmat,
+        )
+        error = None
+    except Exception:
+        tmat = None
+        thumbnail = None
+        error = traceback.format_exc()
+    return dict(
+        idx=idx,
+        file=mov_img_path,
+        tmat=tmat,
+        thumbnail=thumbnail,
+        error=error,
+        duration=time.perf_counter() - start,
+        stats=None if stats is None else stats.to_dict(),
+    )
+
+
+def prefetch_images(paths, load_func, num_readers=2, max_prefetch=2):
+    """
+        Loads images in background threads, so that reading the next stacks
+        from disk overlaps with processing the current one.
+
+        Parameters:
+            paths : list of files to load
+            load_func : function(path) -> image
+            num_readers : number of threads reading at the same time
+            max_prefetch : at most this many images are loaded (or loading)
+                but not yet taken by the consumer. Limits memory.
+
+        Yields:
+            tuples (idx, img, error, duration) in the order the reads finish.
+            error is a traceback string (and img None) if loading failed.
+    """
+    slots = threading.Semaphore(max(1, max_prefetch))
+    finished = queue.Queue()
+    stop = threading.Event()
+
+    def read(idx, path):
+        start = time.perf_counter()
+        try:
+            img = load_func(path)
+            error = None
+        except Exception:
+            img = None
+            error = traceback.format_exc()
+        finished.put((idx, img, error, time.perf_counter() - start))
+
+    def submit_all(executor):
+        for idx, path in enumerate(paths):
+            # wait for a free slot, but give up when the consumer is gone
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            if stop.is_set():
+                return
+            executor.submit(read, idx, path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_readers) as executor:
+        feeder = threading.Thread(target=submit_all, args=(executor,), daemon=True)
+        feeder.start()
+        try:
+            for _ in range(len(paths)):
+                res = finished.get()
+                slots.release()
+                yield res
+        finally:
+            stop.set()
+            feeder.join()
+
+
+def align_batch(
+    jobs,
+    ref_img,
+    ref_points,
+    roi_width=10,
+    use_average=True,
+    frames_for_average=1000,
+    frame_sampling="even",
+    projection_cache_dir=None,
+    projection_cache_bytes=5 * 1024 ** 3,
+    thumbnail_factor=None,
+    coarse_to_fine=True,
+    estimate_rotation=False,
+    num_workers=1,
+    num_readers=2,
+    max_prefetch=2,
+    instrument=False,
+    stats_hooks=None,
+    trace_memory=False,
+    report_path=None,
+):
+    """
+        Aligns many files to the same reference.
+
+        Stacks are read by `num_readers` background threads while the
+        workers register, so disk and cpu are busy at the same time.
+
+        Parameters:
+            jobs : list of tuples (mov_img_path, roi_path, img_path) or
+                (mov_img_path, roi_path, img_path, tmat). With a tmat (not None),
+                e.g. from a previous run, the registration is skipped.
+            ref_img : the stretched reference image
+            ref_points : array of rois, columns are col, row, id
+            num_workers : number of processes. 1 runs everything in this process,
+                None uses one process per cpu
+            num_readers : number of threads that read stacks ahead of time.
+                0 to let every worker read its own stack
+            max_prefetch : how many stacks may be read ahead at most
+            projection_cache_dir : if set, the averaged images are cached here
+                (at most projection_cache_bytes), see ProjectionCache
+            thumbnail_factor : if set, the results contain previews downscaled
+                by this factor, e.g. for preview.save_contact_sheet
+            coarse_to_fine, estimate_rotation : see register()
+            instrument : if True, every step is timed and the reads are counted,
+                see instrumentation.Stats. The results get a key `stats`.
+            stats_hooks : list of functions hook(stage_name, record) called after
+                every step (in the worker processes), see instrumentation.Stats
+            trace_memory : also find the peak memory of every step (slower)
+            report_path : if set (and instrument), the stats of all files are
+                saved there as json and a summary is printed
+
+        Returns:
+            list of dicts (one per job, in order) with keys
+            file, tmat, thumbnail, error (traceback as string or None), duration,
+            stats (None unless instrument)
+    """
+    settings = make_settings(
+        roi_width=roi_width,
+        use_average=use_average,
+        frames_for_average=frames_for_average,
+        frame_sampling=frame_sampling,
+        projection_cache_dir=projection_cache_dir,
+        projection_cache_bytes=projection_cache_bytes,
+        thumbnail_factor=thumbnail_factor,
+        coarse_to_fine=coarse_to_fine,
+        estimate_rotation=estimate_rotation,
+        instrument=instrument,
+        stats_hooks=stats_hooks,
+        trace_memory=trace_memory,
+    )
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(jobs)))
+    results = [None] * len(jobs)
+    # stats of the reads done by the prefetching threads, by file
+    load_stats = dict()
+
+    def report(res):
+        stats = load_stats.pop(res["file"], None)
+        if stats is not None:
+            if res["stats"] is not None:
+                stats.merge(res["stats"])
+            res["stats"] = stats.to_dict()
+        results[res["idx"]] = res
+        done = sum([r is not None for r in results])
+        status = "Aligned" if res["error"] is None else "Failed"
+        print(
+            f"[{done}/{len(jobs)}] {status} {res['file']} "
+            + f"({res['duration']:.1f}s)"
+        )
+        if res["error"] is not None:
+            print(res["error"])
+
+    # everything that only depends on the reference is done once, here,
+    # and the template is sent to the workers
+    if coarse_to_fine:
+        ref_img = registration.ReferenceTemplate(ref_img, rotation=estimate_rotation)
+
+    # reading is done here (in threads) or in the workers
+    _init_worker(ref_img, ref_points, settings)
+    if num_readers > 0:
+
+        def load(path):
+            load_stats[path] = _new_stats()
+            return _load_task(path, load_stats[path])
+
+        images = prefetch_images(
+            [job[0] for job in jobs], load, num_readers, max_prefetch
+        )
+    else:
+        images = ((idx, None, None, 0.0) for idx in range(len(jobs)))
+
+    if num_workers == 1:
+        for idx, mov_img, error, duration in images:
+            if error is not None:
+                report(failed_result(idx, jobs[idx][0], error, duration))
+                continue
+            res = _align_task(idx, *jobs[idx], mov_img=mov_img)
+            res["duration"] += duration
+            report(res)
+    else:
+        # job index of every submitted task, to report it if its worker dies
+        submitted = dict()
+
+        def collect(future):
+            idx = submitted.pop(future)
+            report(
+                result_or_error(
+                    future, lambda error: failed_result(idx, jobs[idx][0], error)
+                )
+            )
+
+        with RestartingPool(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(ref_img, ref_points, settings),
+        ) as executor:
+            pending = set()
+            for idx, mov_img, error, duration in images:
+                if error is not None:
+                    report(failed_result(idx, jobs[idx][0], error, duration))
+                    continue
+                future = executor.submit(_align_task, idx, *jobs[idx], mov_img=mov_img)
+                submitted[future] = idx
+                pending.add(future)
+                # do not hand out more images than there are workers to take them
+                while len(pending) >= num_workers:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        collect(future)
+            for future in concurrent.futures.as_completed(pending):
+                collect(future)
+
+    if instrument and report_path is not None:
+        instrumentation.print_summary(
+            instrumentation.write_report(report_path, results)
+        )
+    return results
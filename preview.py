@@ -0,0 +1,133 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 14:02:11
+# @Last Modified: 2026-10-17 14:02:11
+# ------------------------------------------------------------------------------ #
+# Preview images with rois drawn on top, to check if the alignment worked.
+# Composited directly in numpy and written as png, no matplotlib figures
+# are involved so this is cheap and does not accumulate memory.
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+from skimage import io
+
+import utility as ut
+import contrast
+
+try:
+    # only needed to write labels on the contact sheet
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+
+def to_gray(img):
+    """
+        Maps the image linearly from its min and max to 0 - 255 (uint8),
+        as imshow(img, cmap="gray") does
+    """
+    lo = np.min(img)
+    hi = np.max(img)
+
+    def scale(values):
+        gray = np.asarray(values, dtype=np.float32) - lo
+        if hi > lo:
+            gray *= 255.0 / (hi - lo)
+        return gray.astype(np.uint8)
+
+    if contrast.has_lut(img):
+        # no float copy of the whole image
+        return contrast.apply_lut(img, contrast.lookup_table(img.dtype, scale))
+    return scale(img)
+
+
+def composite(img, mask):
+    """
+        Draws the rgba `mask` (uint8, height * width * 4) over the grayscale
+        version of `img`. Returns rgb, uint8, height * width * 3
+    """
+    gray = to_gray(img).astype(np.float32)
+    alpha = mask[:, :, 3:4].astype(np.float32) / 255.0
+    rgb = gray[:, :, np.newaxis] * (1.0 - alpha) + mask[:, :, 0:3] * alpha
+    return np.rint(rgb).astype(np.uint8)
+
+
+def downscale(rgb, factor):
+    """
+        Averages blocks of `factor` * `factor` pixels, for thumbnails
+    """
+    if factor is None or factor <= 1:
+        return rgb
+    height = rgb.shape[0] // factor
+    width = rgb.shape[1] // factor
+    rgb = rgb[: height * factor, : width * factor]
+    rgb = rgb.reshape(height, factor, width, factor, -1).mean(axis=(1, 3))
+    return np.rint(rgb).astype(np.uint8)
+
+
+def render(img, points, roi_width, channel=0, alpha=123):
+    """
+        The rgb preview of `img` with a square for every point (col, row)
+        in the given color `channel` (0 red, 1 green, 2 blue)
+    """
+    height, width = img.shape[0:2]
+    mask = np.zeros(shape=(height, width, 4), dtype="uint8")
+    ut.paint_rois(points, roi_width, mask, channel=channel, alpha=alpha)
+    return composite(img, mask)
+
+
+def save_preview(fname, img, points, roi_width, channel=0, thumbnail_factor=None):
+    """
+        Renders the preview and saves it as png to `fname`.
+        If a `thumbnail_factor` is given, a downscaled version is returned
+        (e.g. for the contact sheet), otherwise None.
+    """
+    rgb = render(img, points, roi_width, channel)
+    io.imsave(fname, rgb, check_contrast=False)
+    if thumbnail_factor is None:
+        return None
+    return downscale(rgb, thumbnail_factor)
+
+
+def save_contact_sheet(fname, thumbnails, labels=None, num_cols=None):
+    """
+        Tiles many (small) rgb images into one png, to check all sessions
+        at a glance. Images are placed row by row in the order given.
+        Labels are written in the top left corner if Pillow is available.
+    """
+    if labels is None:
+        labels = [None] * len(thumbnails)
+    labels = [l for l, t in zip(labels, thumbnails) if t is not None]
+    thumbnails = [t for t in thumbnails if t is not None]
+    if len(thumbnails) == 0:
+        return
+    if num_cols is None:
+        num_cols = int(np.ceil(np.sqrt(len(thumbnails))))
+    num_rows = int(np.ceil(len(thumbnails) / num_cols))
+    tile_h = max([t.shape[0] for t in thumbnails])
+    tile_w = max([t.shape[1] for t in thumbnails])
+    pad = 2
+
+    sheet = np.full(
+        shape=(num_rows * (tile_h + pad) - pad, num_cols * (tile_w + pad) - pad, 3),
+        fill_value=255,
+        dtype=np.uint8,
+    )
+    for idx, thumb in enumerate(thumbnails):
+        row = (idx // num_cols) * (tile_h + pad)
+        col = (idx % num_cols) * (tile_w + pad)
+        sheet[row : row + thumb.shape[0], col : col + thumb.shape[1]] = thumb[:, :, 0:3]
+
+    if Image is not None and any([l is not None for l in labels]):
+        pil = Image.fromarray(sheet)
+        draw = ImageDraw.Draw(pil)
+        for idx, label in enumerate(labels):
+            if label is None:
+                continue
+            row = (idx // num_cols) * (tile_h + pad)
+            col = (idx % num_cols) * (tile_w + pad)
+            draw.text((col + 3, row + 2), str(label), fill=(255, 255, 0))
+        sheet = np.asarray(pil)
+
+    io.imsave(fname, sheet, check_contrast=False)
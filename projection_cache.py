@@ -0,0 +1,130 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 13:05:48
+# @Last Modified: 2026-10-17 13:05:48
+# ------------------------------------------------------------------------------ #
+# On-disk cache for projections (averaged images) of .his stacks, so that
+# changing registration parameters does not require to read all stacks again.
+# ------------------------------------------------------------------------------ #
+
+import os
+import json
+import hashlib
+import numpy as np
+
+import reduction
+
+
+def file_identity(file_path):
+    """
+        Identifies the content of a file without reading it: path, size and mtime
+    """
+    file_path = os.path.abspath(os.path.expanduser(file_path))
+    stat = os.stat(file_path)
+    return [file_path, stat.st_size, stat.st_mtime_ns]
+
+
+class ProjectionCache:
+    """
+        Stores 2d images in compressed .npz files, one per key.
+        When the cache grows beyond `max_bytes`, the least recently used
+        entries are removed.
+
+        Example:
+            .. code-block:: python
+                cache = ProjectionCache("~/.cache/his_stackreg/projections")
+                key = cache.key(file_path, frames=1000, func=np.nanmax)
+                img = cache.get(key)
+                if img is None:
+                    img = HisOpener(file_path).read_frame_average(1000)
+                    cache.put(key, img)
+            ..
+    """
+
+    def __init__(
+        self, cache_dir="~/.cache/his_stackreg/projections", max_bytes=5 * 1024 ** 3
+    ):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, file_path, frames, func=np.nanmax, dtype=None, **kwargs):
+        """
+            Key for the projection of `file_path` over `frames` (a number of
+            frames or an array of indices) using `func`. Further keyword
+            arguments (e.g. sampling, roi, binning) become part of the key.
+        """
+        if isinstance(frames, np.ndarray):
+            frames = (
+                "sha1:" + hashlib.sha1(frames.astype(np.int64).tobytes()).hexdigest()
+            )
+        name = func if isinstance(func, str) else reduction.reducer_name(func)
+        if name is None:
+            # arbitrary function, identified by its name
+            name = getattr(func, "__module__", "") + "."
+            name += getattr(func, "__qualname__", str(func))
+        desc = dict(
+            file=file_identity(file_path),
+            frames=frames,
+            func=name,
+            dtype=None if dtype is None else np.dtype(dtype).name,
+            **kwargs,
+        )
+        desc = json.dumps(desc, sort_keys=True, default=str)
+        return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """
+            The cached image or None
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as dat:
+                img = dat["img"]
+            # mark as recently used
+            os.utime(path)
+            return img
+        except Exception:
+            # not cached (or removed by another process meanwhile)
+            return None
+
+    def put(self, key, img):
+        path = self._path(key)
+        # write to temp file first so other processes never see half a file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as tmp:
+            np.savez_compressed(tmp, img=img)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+            Removes least recently used entries until the cache fits max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+            except FileNotFoundError:
+                continue
+        total = sum([e[1] for e in entries])
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.cache_dir, name))
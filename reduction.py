@@ -0,0 +1,341 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 10:31:02
+# @Last Modified: 2026-10-17 10:31:02
+# ------------------------------------------------------------------------------ #
+# Streaming projections of image stacks.
+#
+# Frames are read in chunks and folded into running accumulators so that
+# only the accumulators (and one chunk) are held in memory, no matter how
+# many frames go into the projection. Several projections can be computed in
+# the same pass over the file.
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+
+# default upper limit for accumulators, chunks and temporaries, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+
+class Reducer:
+    """
+        Base class for running projections along the first (frame) axis.
+        Subclasses fold chunks frame_number * height * width via `update`
+        and give the 2d projection via `result`.
+    """
+
+    # bytes of temporaries needed per frame of a chunk, in units of pixels
+    temp_bytes_per_pixel = 0
+    # bytes of frame sized temporaries of every update (or result), per pixel
+    frame_temp_bytes_per_pixel = 0
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+    def nbytes(self):
+        """
+            Bytes held by the accumulators
+        """
+        return 0
+
+    def update(self, chunk):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class MaxReducer(Reducer):
+    frame_temp_bytes_per_pixel = 8
+
+    def __init__(self, shape, dtype):
+        super().__init__(shape, dtype)
+        self.acc = None
+
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def update(self, chunk):
+        if len(chunk) == 0:
+            return
+        if self.acc is None:
+            self.acc = np.max(chunk, axis=0)
+        else:
+            np.maximum(self.acc, np.max(chunk, axis=0), out=self.acc)
+        self.count += len(chunk)
+
+    def result(self):
+        return self.acc
+
+
+class MinReducer(MaxReducer):
+    def update(self, chunk):
+        if len(chunk) == 0:
+            return
+        if self.acc is None:
+            self.acc = np.min(chunk, axis=0)
+        else:
+            np.minimum(self.acc, np.min(chunk, axis=0), out=self.acc)
+        self.count += len(chunk)
+
+
+class MeanReducer(Reducer):
+    frame_temp_bytes_per_pixel = 16
+
+    def __init__(self, shape, dtype):
+        super().__init__(shape, dtype)
+        self.acc = np.zeros(self.shape, dtype=np.float64)
+
+    def nbytes(self):
+        return self.acc.nbytes
+
+    def update(self, chunk):
+        if len(chunk) == 0:
+            return
+        self.acc += np.sum(chunk, axis=0, dtype=np.float64)
+        self.count += len(chunk)
+
+    def result(self):
+        return self.acc / self.count
+
+
+class VarianceReducer(Reducer):
+    """
+        Running variance, chunks are combined with the pairwise update of
+        Chan et al. which is numerically stable for long stacks.
+    """
+
+    # deviations of the chunk, and the mean, m2 and delta terms of the update
+    temp_bytes_per_pixel = 8
+    frame_temp_bytes_per_pixel = 40
+
+    def __init__(self, shape, dtype):
+        super().__init__(shape, dtype)
+        self.mean = np.zeros(self.shape, dtype=np.float64)
+        self.m2 = np.zeros(self.shape, dtype=np.float64)
+
+    def nbytes(self):
+        return self.mean.nbytes + self.m2.nbytes
+
+    def update(self, chunk):
+        n_b = len(chunk)
+        if n_b == 0:
+            return
+        mean_b = np.mean(chunk, axis=0, dtype=np.float64)
+        dev = chunk - mean_b
+        m2_b = np.einsum("ijk,ijk->jk", dev, dev)
+        del dev
+
+        n_a = self.count
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += m2_b + delta ** 2 * (n_a * n_b / n)
+        self.count = n
+
+    def result(self):
+        return self.m2 / self.count
+
+
+class StdReducer(VarianceReducer):
+    def result(self):
+        return np.sqrt(super().result())
+
+
+class PercentileReducer(Reducer):
+    """
+        Approximate percentile via a reservoir sample of at most `capacity`
+        frames, drawn uniformly from all frames that were folded in.
+        Exact if no more than `capacity` frames are seen.
+        `result` works on a copy of the sample.
+    """
+
+    frame_temp_bytes_per_pixel = 24
+
+    def __init__(self, shape, dtype, q=50, capacity=100, seed=42):
+        super().__init__(shape, dtype)
+        self.q = q
+        self.capacity = int(max(1, capacity))
+        self.reservoir = None
+        self.rng = np.random.default_rng(seed)
+
+    def nbytes(self):
+        return self.capacity * int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def update(self, chunk):
+        if self.reservoir is None:
+            self.reservoir = np.empty(
+                shape=(self.capacity,) + self.shape, dtype=self.dtype
+            )
+        for frame in chunk:
+            if self.count < self.capacity:
+                self.reservoir[self.count] = frame
+            else:
+                # algorithm R
+                j = self.rng.integers(0, self.count + 1)
+                if j < self.capacity:
+                    self.reservoir[j] = frame
+            self.count += 1
+
+    def result(self):
+        num = min(self.count, self.capacity)
+        return np.percentile(self.reservoir[:num], self.q, axis=0)
+
+
+# numpy functions that have a streaming equivalent
+_func_names = {
+    np.max: "max",
+    np.nanmax: "max",
+    np.min: "min",
+    np.nanmin: "min",
+    np.mean: "mean",
+    np.nanmean: "mean",
+    np.var: "var",
+    np.nanvar: "var",
+    np.std: "std",
+    np.nanstd: "std",
+    np.median: "median",
+    np.nanmedian: "median",
+}
+
+
+def reducer_name(func):
+    """
+        Name of the streaming projection for `func`, which can be a string
+        like "max", "mean", "std", "median" or "p98" (98th percentile)
+        or a numpy function like np.nanmax. None if there is no streaming
+        equivalent.
+    """
+    if isinstance(func, str):
+        name = func.lower()
+        if name in ["max", "min", "mean", "var", "std", "median"]:
+            return name
+        if name.startswith("p"):
+            try:
+                q = float(name[1:])
+                assert 0 <= q <= 100
+                return name
+            except (ValueError, AssertionError):
+                pass
+        raise ValueError(f"Unknown projection {func}")
+    try:
+        return _func_names.get(func, None)
+    except TypeError:
+        return None
+
+
+def create_reducer(name, shape, dtype, capacity=100):
+    if name == "max":
+        return MaxReducer(shape, dtype)
+    elif name == "min":
+        return MinReducer(shape, dtype)
+    elif name == "mean":
+        return MeanReducer(shape, dtype)
+    elif name == "var":
+        return VarianceReducer(shape, dtype)
+    elif name == "std":
+        return StdReducer(shape, dtype)
+    elif name == "median":
+        return PercentileReducer(shape, dtype, q=50, capacity=capacity)
+    elif name.startswith("p"):
+        return PercentileReducer(shape, dtype, q=float(name[1:]), capacity=capacity)
+    raise ValueError(f"Unknown projection {name}")
+
+
+def stream_projections(
+    his,
+    frames,
+    funcs=("max",),
+    memory_budget=None,
+    chunk_size=None,
+    roi=None,
+    binning=1,
+):
+    """
+        Computes one or more projections over the provided frames of `his`
+        in a single pass, reading `chunk_size` frames at a time.
+
+        Parameters:
+            his : HisOpener (or anything with read_frame_stack, frame_shape
+                and pixel_type)
+            frames : array of frame indices
+            funcs : list of projection names or numpy functions, see reducer_name()
+            memory_budget : bytes available for accumulators, the chunk (as
+                read, before cropping and binning) and the temporaries of the
+                reducers. Determines the chunk size (unless given) and how many
+                frames the percentile sketches can hold. A budget that does not
+                fit the accumulators and a single frame is exceeded.
+                Default DEFAULT_MEMORY_BUDGET
+            chunk_size : number of frames per read
+            roi, binning : passed to his.read_frame_stack, so every chunk is
+                cropped and binned before it is folded in
+
+        Returns:
+            dict mapping the projection names to 2d arrays. max and min keep
+            the pixel type, the others are float64.
+    """
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    frames = np.asarray(frames)
+    shape = his.frame_shape(roi, binning)
+    dtype = np.dtype(his.pixel_type)
+    num_pixels = int(np.prod(shape))
+    frame_bytes = num_pixels * dtype.itemsize
+    # rows are read at full width and binned afterwards
+    read_bytes = shape[0] * binning * getattr(his, "width", shape[1] * binning)
+    read_bytes *= dtype.itemsize
+
+    names = []
+    for func in funcs:
+        name = reducer_name(func)
+        if name is None:
+            raise ValueError(f"No streaming projection for {func}")
+        if name not in names:
+            names.append(name)
+
+    reducers = {n: create_reducer(n, shape, dtype, 1) for n in names}
+    sketches = [n for n in names if n == "median" or n.startswith("p")]
+
+    # needed no matter the chunk size: frame sized temporaries and the scratch
+    # buffer for gaps between frames, one per reading thread
+    fixed_bytes = max([r.frame_temp_bytes_per_pixel for r in reducers.values()])
+    fixed_bytes *= num_pixels
+    fixed_bytes += getattr(his, "max_gap_bytes", 0) * getattr(his, "num_threads", 1)
+    available = memory_budget - fixed_bytes
+    available -= sum([reducers[n].nbytes() for n in names if n not in sketches])
+
+    # percentile sketches get half of the rest, including the copy of one
+    # sketch that is made for its result. the other half is for chunks
+    if len(sketches) > 0:
+        capacity = (available // 2) // ((len(sketches) + 1) * frame_bytes)
+        capacity = int(np.clip(capacity, 1, max(1, len(frames))))
+        for n in sketches:
+            reducers[n] = create_reducer(n, shape, dtype, capacity)
+            available -= reducers[n].nbytes()
+    reducers = [reducers[n] for n in names]
+
+    if chunk_size is None:
+        # per frame of a chunk: the rows as read and the temporaries of the
+        # reducers. binning keeps the rows until a smaller copy is done
+        temp_bytes = max([r.temp_bytes_per_pixel for r in reducers]) * num_pixels
+        per_frame = read_bytes + temp_bytes
+        if binning > 1:
+            per_frame = max(
+                read_bytes + (4 + dtype.itemsize) * num_pixels,
+                frame_bytes + temp_bytes,
+            )
+        chunk_size = available // per_frame
+    chunk_size = int(max(1, chunk_size))
+
+    for start in range(0, len(frames), chunk_size):
+        chunk = his.read_frame_stack(
+            frames[start : start + chunk_size], roi=roi, binning=binning
+        )
+        for r in reducers:
+            r.update(chunk)
+        del chunk
+
+    return {n: r.result() for n, r in zip(names, reducers)}
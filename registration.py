@@ -0,0 +1,277 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 14:35:20
+# @Last Modified: 2026-10-17 14:35:20
+# ------------------------------------------------------------------------------ #
+# Coarse to fine registration.
+#
+# StackReg on its own starts from the identity and can get stuck in a local
+# optimum when the drift between sessions is large. Here, we first estimate
+# the translation (and optionally rotation) with phase correlation on
+# downscaled images, refine it on a pyramid and only then run StackReg at
+# full resolution on the pre-aligned image, to find the residual.
+#
+# All transformation matrices (tmat) follow the pystackreg convention:
+# 3x3, mapping (x, y) = (col, row) coordinates of the reference to the
+# coordinates of the moving image.
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+from skimage import transform as tf
+from pystackreg import StackReg  # pip install pystackreg
+
+
+def translation_matrix(dx, dy):
+    return np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]])
+
+
+def rotation_matrix(angle, center=(0.0, 0.0)):
+    """
+        Rotation by `angle` (degrees, counter-clockwise in image coordinates
+        where y points down) around `center` (x, y)
+    """
+    a = np.deg2rad(angle)
+    rot = np.array(
+        [[np.cos(a), np.sin(a), 0.0], [-np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]]
+    )
+    cx, cy = center
+    return translation_matrix(cx, cy) @ rot @ translation_matrix(-cx, -cy)
+
+
+def scale_tmat(tmat, factor):
+    """
+        Converts a tmat found on images downscaled by `factor` to full resolution
+        (or, with 1/factor, the other way round)
+    """
+    scale = np.diag([factor, factor, 1.0])
+    return scale @ tmat @ np.linalg.inv(scale)
+
+
+def downscale(img, factor):
+    """
+        Block average over `factor` * `factor` pixels, as float32
+    """
+    img = np.asarray(img, dtype=np.float32)
+    if factor <= 1:
+        return img
+    return tf.downscale_local_mean(img, (factor, factor)).astype(np.float32)
+
+
+def warp(img, tmat):
+    """
+        Moves `img` into the coordinate system of the reference, so that
+        it can be compared pixel by pixel (same as StackReg.transform)
+    """
+    return tf.warp(img, tmat, order=1, mode="edge", preserve_range=True).astype(
+        np.float32
+    )
+
+
+def _window(shape):
+    # hann window, so that image borders do not dominate the spectrum
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _normalize(img):
+    img = np.asarray(img, dtype=np.float32)
+    return (img - img.mean()) * _window(img.shape)
+
+
+def _peak(corr):
+    """
+        Position of the maximum of the (circular) cross correlation `corr`,
+        with subpixel precision from a parabola through the neighbours.
+        Returns (dy, dx), wrapped to +- half the size
+    """
+    shape = np.array(corr.shape)
+    peak = np.array(np.unravel_index(np.argmax(corr), corr.shape))
+    shift = peak.astype(np.float64)
+    for axis in range(2):
+        idx = list(peak)
+        idx[axis] = (peak[axis] - 1) % shape[axis]
+        lo = corr[tuple(idx)]
+        idx[axis] = (peak[axis] + 1) % shape[axis]
+        hi = corr[tuple(idx)]
+        mid = corr[tuple(peak)]
+        denom = lo - 2 * mid + hi
+        if denom != 0:
+            shift[axis] += 0.5 * (lo - hi) / denom
+    shift[shift > shape / 2] -= shape[shift > shape / 2]
+    return shift
+
+
+def phase_correlation(ref, mov, ref_fft=None):
+    """
+        Estimates the translation between two images of the same shape.
+        Returns (dx, dy) so that `mov` at (x + dx, y + dy) matches `ref` at (x, y),
+        i.e. translation_matrix(dx, dy) is the tmat.
+
+        `ref_fft` can be provided to skip the transform of the reference,
+        see reference_fft
+    """
+    if ref_fft is None:
+        ref_fft = reference_fft(ref)
+    mov_fft = np.fft.rfft2(_normalize(mov))
+    cross = mov_fft * np.conj(ref_fft)
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.irfft2(cross, s=mov.shape)
+    dy, dx = _peak(corr)
+    return dx, dy
+
+
+def reference_fft(ref):
+    """
+        The (windowed) spectrum of the reference, as needed for phase_correlation
+    """
+    return np.fft.rfft2(_normalize(ref))
+
+
+def _polar_spectrum(img, num_angles=360):
+    """
+        Magnitude spectrum resampled on a polar grid with log-radius, rows are
+        angles from 0 to 180 degree. Rotating the image shifts the rows,
+        translations do not change the magnitude spectrum at all.
+    """
+    spec = np.abs(np.fft.fftshift(np.fft.fft2(_normalize(img))))
+    # high-pass, low frequencies carry mostly the overall brightness
+    spec = np.log1p(spec)
+    radius = min(img.shape) // 2
+    polar = tf.warp_polar(
+        spec, radius=radius, output_shape=(num_angles, radius), scaling="log"
+    )
+    # spectrum is point symmetric, only half the angles are unique
+    return polar[: num_angles // 2].astype(np.float32)
+
+
+def reference_polar(ref):
+    return reference_fft(_polar_spectrum(ref))
+
+
+def estimate_rotation(ref, mov, ref_polar=None):
+    """
+        Rotation angle (degrees) between the images, in the sense of
+        rotation_matrix, estimated from their log-polar spectra.
+        Only unique up to 180 degree, the smaller angle is returned.
+    """
+    if ref_polar is None:
+        ref_polar = reference_polar(ref)
+    mov_polar = _polar_spectrum(mov)
+    # rows are half-degree steps over 180 degree
+    d_radius, d_angle = phase_correlation(None, mov_polar, ref_fft=ref_polar)
+    return -d_angle * 180.0 / mov_polar.shape[0]
+
+
+class ReferenceTemplate:
+    """
+        Everything about the reference that registration needs, computed once
+        so that aligning many images to the same reference only costs the
+        work on the moving images. Plain numpy arrays, so it can be pickled
+        to worker processes.
+
+        Example:
+            .. code-block:: python
+                template = ReferenceTemplate(ref_img)
+                for mov_img in mov_imgs:
+                    tmat = template.register(mov_img)
+            ..
+
+        Parameters:
+            ref_img : the (contrast stretched) reference image
+            downscale_factor, levels, rotation, final_stackreg, transformation :
+                see register()
+    """
+
+    def __init__(
+        self,
+        ref_img,
+        downscale_factor=4,
+        levels=(2, 1),
+        rotation=False,
+        final_stackreg=True,
+        transformation=StackReg.RIGID_BODY,
+    ):
+        self.img = np.asarray(ref_img, dtype=np.float32)
+        self.shape = self.img.shape
+        self.center = ((self.shape[1] - 1) / 2, (self.shape[0] - 1) / 2)
+        self.downscale_factor = downscale_factor
+        self.levels = tuple(levels)
+        self.rotation = rotation
+        self.final_stackreg = final_stackreg
+        self.transformation = transformation
+
+        # downscaled images and their spectra, by factor
+        self.pyramid = dict()
+        self.ffts = dict()
+        for factor in (downscale_factor,) + self.levels:
+            if factor not in self.pyramid:
+                self.pyramid[factor] = downscale(self.img, factor)
+                self.ffts[factor] = reference_fft(self.pyramid[factor])
+        self.polar = None
+        if rotation:
+            self.polar = reference_polar(self.pyramid[downscale_factor])
+
+    def register(self, mov_img, init=None):
+        """
+            The tmat that aligns `mov_img` to the reference.
+
+            If an initial estimate `init` (3x3 tmat, e.g. from a previous session)
+            is provided, the coarse step is skipped and the pyramid starts from it.
+        """
+        mov = np.asarray(mov_img, dtype=np.float32)
+        assert mov.shape == self.shape, "images need to have the same shape"
+
+        # coarse estimate
+        if init is None:
+            factor = self.downscale_factor
+            tmat = np.eye(3)
+            mov_c = downscale(mov, factor)
+            if self.rotation:
+                angle = estimate_rotation(None, mov_c, ref_polar=self.polar)
+                tmat = rotation_matrix(angle, self.center)
+                mov_c = warp(mov_c, scale_tmat(tmat, 1 / factor))
+            dx, dy = phase_correlation(None, mov_c, ref_fft=self.ffts[factor])
+            tmat = tmat @ translation_matrix(dx * factor, dy * factor)
+        else:
+            tmat = np.array(init, dtype=np.float64)
+
+        # pyramid refinement
+        for factor in self.levels:
+            mov_l = warp(downscale(mov, factor), scale_tmat(tmat, 1 / factor))
+            dx, dy = phase_correlation(None, mov_l, ref_fft=self.ffts[factor])
+            tmat = tmat @ translation_matrix(dx * factor, dy * factor)
+
+        # residual at full resolution
+        if self.final_stackreg:
+            sreg = StackReg(self.transformation)
+            tmat = tmat @ sreg.register(ref=self.img, mov=warp(mov, tmat))
+
+        return tmat
+
+
+def register(
+    ref,
+    mov,
+    downscale_factor=4,
+    levels=(2, 1),
+    rotation=False,
+    final_stackreg=True,
+    transformation=StackReg.RIGID_BODY,
+):
+    """
+        Finds the tmat that aligns `mov` to `ref`, coarse to fine:
+
+        1. phase correlation (and log-polar rotation, if `rotation`) on images
+            downscaled by `downscale_factor`
+        2. for every factor in `levels`, phase correlation of the reference
+            and the pre-aligned moving image at that resolution
+        3. StackReg on the pre-aligned image at full resolution. The residual
+            transform is combined with the coarse estimate.
+
+        Returns the 3x3 tmat, as StackReg.register would.
+        To align many images to the same reference, use ReferenceTemplate.
+    """
+    template = ReferenceTemplate(
+        ref, downscale_factor, levels, rotation, final_stackreg, transformation
+    )
+    return template.register(mov)
@@ -0,0 +1,144 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 15:02:44
+# @Last Modified: 2026-10-17 15:02:44
+# ------------------------------------------------------------------------------ #
+# Writes synthetic .his stacks in the layout that HisOpener parses, so that
+# reading and alignment can be tested and benchmarked without real recordings.
+#
+# Layout (all little endian):
+#   every frame starts with a 64 byte header: "IM", the offset (short) to the
+#   image data after the header, width, height, (short) pixel size at byte 12
+#   and the number of frames (uint) at byte 14.
+#   After the header of the first frame, `base_offset` bytes of meta data
+#   "@Hokawo@key=value;...~Hokawo~" follow, after all other headers
+#   `frame_offset` bytes of (here) zeros. Then the image data.
+# ------------------------------------------------------------------------------ #
+
+import struct
+import numpy as np
+from scipy import ndimage
+
+
+def scene(width=1024, height=1024, num_cells=400, cell_size=3, seed=42):
+    """
+        A float image in [0, 1] that looks roughly like a recording of cells:
+        blurred spots on a smooth, dim background
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((height, width), dtype=np.float32)
+    rows = rng.integers(0, height, size=num_cells)
+    cols = rng.integers(0, width, size=num_cells)
+    img[rows, cols] = rng.uniform(0.5, 1.0, size=num_cells)
+    img = ndimage.gaussian_filter(img, cell_size)
+    img += 0.05 * ndimage.gaussian_filter(rng.random((height, width)), 16)
+    return img / img.max()
+
+
+def moved_scene(img, shift=(0, 0), rotation=0):
+    """
+        `img` rotated by `rotation` degrees around its center and then shifted
+        by (rows, cols), the way a recording from another day would look
+    """
+    if rotation != 0:
+        img = ndimage.rotate(img, rotation, reshape=False, order=1, mode="reflect")
+    if shift[0] != 0 or shift[1] != 0:
+        img = ndimage.shift(img, shift, order=1, mode="reflect")
+    return img
+
+
+def noisy_frames(img, num_frames, pixel_type="uint16", noise=0.05, seed=42):
+    """
+        Generator of `num_frames` frames of the scene `img` with poisson-like
+        noise, scaled to the range of `pixel_type`
+    """
+    rng = np.random.default_rng(seed)
+    top = 200 if np.dtype(pixel_type).itemsize == 1 else 4000
+    base = 0.1 * top + 0.8 * top * img
+    for _ in range(num_frames):
+        frame = base + noise * top * rng.standard_normal(img.shape)
+        yield np.clip(frame, 0, np.iinfo(pixel_type).max).astype(pixel_type)
+
+
+def write_his(
+    file_path,
+    frames=None,
+    num_frames=None,
+    width=256,
+    height=256,
+    pixel_type="uint16",
+    base_offset=512,
+    frame_offset=64,
+    meta_data=None,
+    bad_offsets=None,
+    seed=42,
+):
+    """
+        Writes a .his file.
+
+        Parameters:
+            frames : array frame_number * height * width or an iterable of 2d
+                frames (e.g. noisy_frames, then the file is written frame by
+                frame and never held in memory). None for noise.
+            num_frames : number of frames to write. Required if `frames`
+                is a generator.
+            width, height, pixel_type : only used if `frames` is None
+            base_offset : bytes of meta data after the first header
+            frame_offset : bytes after the header of all other frames
+            meta_data : dict, written as @Hokawo@key=value;...~Hokawo~
+            bad_offsets : dict frame -> offset, to write frames whose header size
+                differs from `frame_offset` (as in broken recordings).
+                HisOpener then has to find them with check_consistency.
+
+        Returns:
+            number of bytes written
+    """
+    if frames is None:
+        rng = np.random.default_rng(seed)
+        num_frames = 10 if num_frames is None else num_frames
+        top = np.iinfo(pixel_type).max
+        frames = (
+            rng.integers(0, top, size=(height, width), dtype=pixel_type)
+            for _ in range(num_frames)
+        )
+    elif num_frames is None:
+        num_frames = len(frames)
+    if meta_data is None:
+        meta_data = dict(synthetic=1, date="2026/10/17")
+    if bad_offsets is None:
+        bad_offsets = dict()
+
+    meta_str = ";".join([f"{k}={v}" for k, v in meta_data.items()])
+    meta_str = f"@Hokawo@{meta_str};~Hokawo~".encode("utf-8")
+    assert len(meta_str) <= base_offset, "meta data does not fit into base_offset"
+
+    written = 0
+    with open(file_path, "wb") as f:
+        for idx, frame in enumerate(frames):
+            if idx >= num_frames:
+                break
+            frame = np.asarray(frame)
+            height, width = frame.shape
+            pixel_size = frame.dtype.itemsize
+            if idx == 0:
+                offset = base_offset
+                extra = meta_str + b" " * (base_offset - len(meta_str))
+            else:
+                offset = bad_offsets.get(idx, frame_offset)
+                extra = bytes(offset)
+
+            header = bytearray(64)
+            header[0:2] = b"IM"
+            struct.pack_into("<h", header, 2, offset)
+            struct.pack_into("<h", header, 4, width)
+            struct.pack_into("<h", header, 6, height)
+            struct.pack_into("<h", header, 12, pixel_size)
+            struct.pack_into("<I", header, 14, num_frames)
+
+            f.write(header)
+            f.write(extra)
+            f.write(frame.astype(frame.dtype.newbyteorder("<")).tobytes())
+            written += len(header) + len(extra) + frame.nbytes
+
+    return written
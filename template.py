@@ -0,0 +1,197 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 19:48:15
+# @Last Modified: 2026-10-17 19:48:15
+# ------------------------------------------------------------------------------ #
+# Consensus template: instead of matching every session to the (noisy) image
+# of a single day, all sessions are aligned, warped onto the reference and
+# averaged. The sessions are then registered again to this average.
+#
+# The average is kept as running sum (and per-pixel count), every session
+# only adds (or, when its transform changes, replaces) its own contribution.
+# Sessions whose transform did not change by more than `tolerance` pixels
+# in a pass are not registered again.
+# ------------------------------------------------------------------------------ #
+
+import os
+import traceback
+import concurrent.futures
+import numpy as np
+from skimage import transform as tf
+
+import pipeline
+import registration
+
+
+def warp_to_reference(img, tmat):
+    """
+        The image in reference coordinates and which pixels it covers,
+        both float32. Pixels outside of the image are 0.
+    """
+    img = np.asarray(img, dtype=np.float32)
+    warped = tf.warp(img, tmat, order=1, mode="constant", cval=0, preserve_range=True)
+    coverage = tf.warp(
+        np.ones_like(img), tmat, order=1, mode="constant", cval=0, preserve_range=True
+    )
+    return warped.astype(np.float32), coverage.astype(np.float32)
+
+
+def transform_change(tmat_a, tmat_b, shape):
+    """
+        How far (in pixels) the image corners move between two tmats
+    """
+    if tmat_a is None or tmat_b is None:
+        return np.inf
+    height, width = shape
+    corners = np.array(
+        [[0, 0, 1], [width - 1, 0, 1], [0, height - 1, 1], [width - 1, height - 1, 1]],
+        dtype=np.float64,
+    )
+    diff = corners @ np.asarray(tmat_a).T - corners @ np.asarray(tmat_b).T
+    return float(np.max(np.linalg.norm(diff[:, 0:2], axis=1)))
+
+
+def _register_task(file, old_tmat):
+    """
+        Registers one session to the current template (in a worker) and
+        returns how the running sum and count change: its new warped image
+        minus the old one.
+    """
+    try:
+        template = pipeline._worker_ref["ref_img"]
+        mov_img = pipeline.stretch_contrast(pipeline._load_task(file))
+        tmat = template.register(mov_img, init=old_tmat)
+        d_sum, d_count = warp_to_reference(mov_img, tmat)
+        if old_tmat is not None:
+            old_sum, old_count = warp_to_reference(mov_img, old_tmat)
+            d_sum -= old_sum
+            d_count -= old_count
+        return dict(file=file, tmat=tmat, d_sum=d_sum, d_count=d_count, error=None)
+    except Exception:
+        return dict(file=file, tmat=None, error=traceback.format_exc())
+
+
+def build_template(
+    ref_img,
+    files,
+    passes=2,
+    tolerance=0.5,
+    num_workers=1,
+    use_average=True,
+    frames_for_average=1000,
+    frame_sampling="even",
+    projection_cache_dir=None,
+    projection_cache_bytes=5 * 1024 ** 3,
+    estimate_rotation=False,
+):
+    """
+        Registers all sessions to the reference, averages them into a template
+        and refines the transforms against the template in further passes.
+
+        Parameters:
+            ref_img : the stretched reference image. It is part of the average
+                and keeps the template in reference coordinates, so rois of the
+                reference can be moved with the resulting tmats.
+            files : .his files of the sessions
+            passes : refinement passes after the first registration
+            tolerance : sessions whose transform changed by less than this
+                (pixels, see transform_change) are not registered again
+            num_workers : sessions registered in parallel (processes)
+            use_average, frames_for_average, frame_sampling, projection_cache_dir,
+            projection_cache_bytes : how to load the sessions, see
+                pipeline.align_batch. With the cache, every pass after the first
+                only reads the cached projections.
+            estimate_rotation : see registration.register
+
+        Returns:
+            dict with
+            template : the consensus image (float32)
+            tmats : dict file -> tmat to the template (None if it failed)
+            errors : dict file -> traceback, for sessions that failed
+    """
+    settings = pipeline.make_settings(
+        use_average=use_average,
+        frames_for_average=frames_for_average,
+        frame_sampling=frame_sampling,
+        projection_cache_dir=projection_cache_dir,
+        projection_cache_bytes=projection_cache_bytes,
+        estimate_rotation=estimate_rotation,
+    )
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(files)))
+
+    # the reference counts as one session that never moves
+    shape = np.shape(ref_img)
+    img_sum = np.asarray(ref_img, dtype=np.float64).copy()
+    img_count = np.ones(shape, dtype=np.float64)
+    template_img = np.asarray(ref_img, dtype=np.float32)
+
+    tmats = {file: None for file in files}
+    errors = dict()
+    todo = list(files)
+
+    for num_pass in range(passes + 1):
+        if len(todo) == 0:
+            break
+        print(f"Template pass {num_pass}: registering {len(todo)} sessions")
+        template = registration.ReferenceTemplate(
+            template_img, rotation=estimate_rotation
+        )
+        changed = []
+
+        def collect(res):
+            file = res["file"]
+            if res["error"] is not None:
+                errors[file] = res["error"]
+                print(f"Failed {file}")
+                return
+            # online mean: replace the old contribution of the session
+            img_sum[:] += res["d_sum"]
+            img_count[:] += res["d_count"]
+            if transform_change(tmats[file], res["tmat"], shape) > tolerance:
+                changed.append(file)
+            tmats[file] = res["tmat"]
+
+        if num_workers == 1:
+            pipeline._init_worker(template, None, settings)
+            for file in todo:
+                collect(_register_task(file, tmats[file]))
+        else:
+            # file of every submitted task, to report it if its worker dies
+            submitted = dict()
+
+            def collect_future(future):
+                file = submitted.pop(future)
+                collect(
+                    pipeline.result_or_error(
+                        future, lambda error: dict(file=file, tmat=None, error=error)
+                    )
+                )
+
+            with pipeline.RestartingPool(
+                max_workers=num_workers,
+                initializer=pipeline._init_worker,
+                initargs=(template, None, settings),
+            ) as executor:
+                pending = set()
+                for file in todo:
+                    future = executor.submit(_register_task, file, tmats[file])
+                    submitted[future] = file
+                    pending.add(future)
+                    # only as many warped images in memory as there are workers
+                    while len(pending) >= num_workers:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            collect_future(future)
+                for future in concurrent.futures.as_completed(pending):
+                    collect_future(future)
+
+        template_img = (img_sum / img_count).astype(np.float32)
+        # only sessions that moved need another look at the new template
+        todo = [file for file in files if file in changed]
+
+    return dict(template=template_img, tmats=tmats, errors=errors)
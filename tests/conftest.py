@@ -0,0 +1,13 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 20:31:02
+# @Last Modified: 2026-10-17 20:31:02
+# ------------------------------------------------------------------------------ #
+# The modules live flat in the repository root, run with `python -m pytest tests`
+# ------------------------------------------------------------------------------ #
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 22:04:51
+# @Last Modified: 2026-10-17 22:04:51
+# ------------------------------------------------------------------------------ #
+
+import tracemalloc
+import numpy as np
+
+import chunked_store
+import synthetic_his
+from his_opener import HisOpener
+
+
+def test_convert_long_chunks_in_budget(tmp_path):
+    path = str(tmp_path / "stack.his")
+    rng = np.random.default_rng(8)
+    frames = rng.integers(0, 60000, size=(100, 64, 48), dtype=np.uint16)
+    synthetic_his.write_his(path, frames=frames)
+    his = HisOpener(path, use_index_cache=False)
+    # ten frames at a time, a time chunk holds 64 frames
+    budget = 10 * frames[0].nbytes
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    try:
+        stack = chunked_store.convert(
+            his, str(tmp_path / "store"), chunks=(64, 20, 20), memory_budget=budget,
+        )
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    assert peak < 2 * budget
+
+    assert stack.chunks == (64, 20, 20)
+    np.testing.assert_array_equal(stack.read_frame_stack(np.arange(100)), frames)
+    np.testing.assert_array_equal(
+        stack.read_frame_stack(np.arange(30, 90), roi=(5, 45, 12, 33)),
+        frames[30:90, 5:45, 12:33],
+    )
@@ -0,0 +1,135 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 20:31:02
+# @Last Modified: 2026-10-17 20:31:02
+# ------------------------------------------------------------------------------ #
+
+import time
+import pytest
+import numpy as np
+
+import instrumentation
+import synthetic_his
+import watch
+from his_opener import HisOpener
+
+
+def frame_positions(num_frames, width, height, base_offset, frame_offset, bad_offsets):
+    """
+        Where synthetic_his.write_his puts every frame header
+    """
+    img_size = width * height * 2
+    pos = np.zeros(num_frames, dtype=np.int64)
+    offset = base_offset
+    for idx in range(1, num_frames):
+        pos[idx] = pos[idx - 1] + 64 + offset + img_size
+        offset = bad_offsets.get(idx, frame_offset)
+    return pos
+
+
+def test_slow_check_many_offset_changes(tmp_path):
+    # every other frame has a different header size
+    num_frames = 16000
+    bad_offsets = {idx: 100 for idx in range(1, num_frames, 2)}
+    path = str(tmp_path / "alternating.his")
+    synthetic_his.write_his(
+        path, num_frames=num_frames, width=8, height=8, bad_offsets=bad_offsets
+    )
+
+    his = HisOpener(path, skip_consistency_check=True, use_index_cache=False)
+    start = time.perf_counter()
+    his.check_consistency_slow()
+    duration = time.perf_counter() - start
+
+    expected = frame_positions(num_frames, 8, 8, 512, 64, bad_offsets)
+    assert not his.is_consistent
+    np.testing.assert_array_equal(his.lookup_pos, expected)
+    # restarting with full blocks after every change took > 10 s
+    assert duration < 3
+
+
+def test_slow_check_few_offset_changes(tmp_path):
+    num_frames = 300
+    bad_offsets = {5: 100, 6: 100, 7: 30, 150: 7, 299: 90}
+    path = str(tmp_path / "few.his")
+    synthetic_his.write_his(
+        path, num_frames=num_frames, width=16, height=8, bad_offsets=bad_offsets
+    )
+    his = HisOpener(path, skip_consistency_check=True, use_index_cache=False)
+    his.check_consistency_slow(block_size=64)
+    expected = frame_positions(num_frames, 16, 8, 512, 64, bad_offsets)
+    np.testing.assert_array_equal(his.lookup_pos, expected)
+    assert his.lookup_offset[7] == 30
+
+
+def test_read_stack_without_extra_buffer(tmp_path):
+    path = str(tmp_path / "stack.his")
+    rng = np.random.default_rng(1)
+    frames = rng.integers(0, 60000, size=(32, 128, 128), dtype=np.uint16)
+    synthetic_his.write_his(path, frames=frames)
+    stats = instrumentation.Stats(trace_memory=True)
+    his = HisOpener(path, stats=stats, use_index_cache=False)
+    with stats.stage("stack"):
+        stack = his.read_frame_stack(np.arange(32))
+    np.testing.assert_array_equal(stack, frames)
+    # frames are read straight into the stack, not into a buffer of the same size
+    assert stats.stages["stack"]["peak_bytes"] < 1.2 * stack.nbytes
+
+
+def test_roi_reads_only_rows(tmp_path):
+    path = str(tmp_path / "roi.his")
+    rng = np.random.default_rng(2)
+    frames = rng.integers(0, 60000, size=(64, 256, 256), dtype=np.uint16)
+    synthetic_his.write_his(path, frames=frames)
+    stats = instrumentation.Stats()
+    his = HisOpener(path, stats=stats, use_index_cache=False)
+    stats.totals["bytes_read"] = 0
+
+    stack = his.read_frame_stack(np.arange(64), roi=(100, 116, 0, 256))
+    np.testing.assert_array_equal(stack, frames[:, 100:116])
+    # 16 rows of every frame and the headers, not the whole frames
+    assert stats.totals["bytes_read"] < 1.1 * stack.nbytes
+
+    # rows of neighbouring frames that are close are still read together
+    stats.totals.update(bytes_read=0, reads=0)
+    stack = his.read_frame_stack(np.arange(64), roi=(0, 250, 0, 256))
+    np.testing.assert_array_equal(stack, frames[:, 0:250])
+    assert stats.totals["bytes_read"] < 1.1 * stack.nbytes
+    assert stats.totals["reads"] < 4
+
+
+def test_quick_check_falls_back_to_slow(tmp_path):
+    rng = np.random.default_rng(5)
+    frames = rng.integers(0, 60000, size=(10, 32, 32), dtype=np.uint16)
+    # "IM" and a plausible header size in the image data of frame 5, right
+    # where the quick check looks when it strides by base_offset from frame 0
+    frames[5, 26, 0:2] = [0x4D49, 64]
+    path = str(tmp_path / "fake_header.his")
+    synthetic_his.write_his(path, frames=frames)
+
+    his = HisOpener(path, skip_consistency_check=True, use_index_cache=False)
+    his.check_consistency()
+    assert his.is_consistent
+    expected = frame_positions(10, 32, 32, 512, 64, dict())
+    np.testing.assert_array_equal(his.lookup_pos, expected)
+    np.testing.assert_array_equal(his.read_frame_stack(np.arange(10)), frames)
+
+
+def test_quick_check_truncated(tmp_path):
+    path = str(tmp_path / "truncated.his")
+    rng = np.random.default_rng(6)
+    frames = rng.integers(0, 60000, size=(10, 32, 32), dtype=np.uint16)
+    size = synthetic_his.write_his(path, frames=frames)
+    with open(path, "r+b") as f:
+        f.truncate(size - 3 * (64 + 64 + 32 * 32 * 2))
+
+    his = HisOpener(path, skip_consistency_check=True, use_index_cache=False)
+    his.check_consistency()
+    assert not his.is_consistent
+    np.testing.assert_array_equal(his.read_frame_stack(np.arange(7)), frames[:7])
+    with pytest.raises(IndexError):
+        his.read_frame(8)
+    with pytest.raises(IndexError):
+        his.read_frame_stack(np.arange(10))
+    assert not watch.is_complete(path)
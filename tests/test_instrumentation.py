@@ -0,0 +1,32 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 22:18:36
+# @Last Modified: 2026-10-17 22:18:36
+# ------------------------------------------------------------------------------ #
+
+import tracemalloc
+
+import instrumentation
+
+MB = 1024 ** 2
+
+
+def test_nested_stage_peaks():
+    stats = instrumentation.Stats(trace_memory=True)
+    try:
+        with stats.stage("outer"):
+            big = bytearray(20 * MB)
+            with stats.stage("small"):
+                small = bytearray(MB // 10)
+            del big
+            with stats.stage("large"):
+                large = bytearray(8 * MB)
+                del large
+    finally:
+        tracemalloc.stop()
+
+    # the inner stages must not reset the peak of the outer one
+    assert stats.stages["outer"]["peak_bytes"] >= 20 * MB
+    assert stats.stages["small"]["peak_bytes"] < MB
+    assert 8 * MB <= stats.stages["large"]["peak_bytes"] < 9 * MB
@@ -0,0 +1,43 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 22:37:02
+# @Last Modified: 2026-10-17 22:37:02
+# ------------------------------------------------------------------------------ #
+
+import os
+import time
+import numpy as np
+
+import pipeline
+
+
+def fake_align_task(idx, mov_img_path, roi_path, img_path, tmat=None, mov_img=None):
+    if "crash" in mov_img_path:
+        # as if the worker was killed, e.g. out of memory
+        os._exit(1)
+    time.sleep(0.2)
+    res = pipeline.failed_result(idx, mov_img_path, None)
+    res["tmat"] = np.eye(3)
+    return res
+
+
+def test_align_batch_survives_dead_worker(monkeypatch):
+    monkeypatch.setattr(pipeline, "_align_task", fake_align_task)
+    names = ["a", "crash", "b", "c", "d", "e"]
+    jobs = [(f"{n}.his", f"{n}_roi.txt", f"{n}.png") for n in names]
+
+    results = pipeline.align_batch(
+        jobs,
+        np.zeros((8, 8)),
+        np.zeros((0, 3)),
+        coarse_to_fine=False,
+        num_workers=2,
+        num_readers=0,
+    )
+    assert len(results) == len(jobs)
+    assert all([res is not None for res in results])
+    assert "BrokenProcessPool" in results[1]["error"]
+    # jobs after the crash run in new worker processes
+    assert results[-1]["error"] is None
+    assert results[-2]["error"] is None
@@ -0,0 +1,38 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 21:20:05
+# @Last Modified: 2026-10-17 21:20:05
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+
+import preview
+import utility as ut
+
+
+def test_paint_rois_non_square():
+    # 200 rows, 300 columns
+    img = np.zeros((200, 300, 4), dtype=np.uint8)
+    points = np.array([[250, 20], [10, 190], [299, 199]])
+    ut.paint_rois(points, 4, img)
+    assert img[20, 250, 0] == 255 and img[20, 250, 3] == 123
+    assert img[190, 10, 0] == 255
+    # squares at the edge are clipped to the last row and column
+    assert img[199, 299, 0] == 255
+    assert img[20, 200, 0] == 0
+    assert img[:, :, 0].sum() == 255 * (16 + 16 + 9)
+
+
+def test_save_preview_non_square(tmp_path):
+    rng = np.random.default_rng(4)
+    img = rng.integers(0, 60000, size=(200, 300), dtype=np.uint16)
+    points = np.array([[250, 20], [10, 190]])
+    thumb = preview.save_preview(
+        str(tmp_path / "preview.png"), img, points, 10, thumbnail_factor=2
+    )
+    assert thumb.shape == (100, 150, 3)
+    rgb = preview.render(img, points, 10)
+    assert rgb.shape == (200, 300, 3)
+    # the roi is red
+    assert rgb[20, 250, 0] > rgb[20, 250, 1]
@@ -0,0 +1,46 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 21:41:18
+# @Last Modified: 2026-10-17 21:41:18
+# ------------------------------------------------------------------------------ #
+
+import tracemalloc
+import numpy as np
+
+import reduction
+import synthetic_his
+from his_opener import HisOpener, bin_frames
+
+
+def test_stream_projections_stay_in_budget(tmp_path):
+    path = str(tmp_path / "budget.his")
+    rng = np.random.default_rng(7)
+    frames = rng.integers(0, 60000, size=(60, 256, 256), dtype=np.uint16)
+    synthetic_his.write_his(path, frames=frames)
+    his = HisOpener(path, use_index_cache=False)
+    budget = 6 * 1024 ** 2
+
+    for roi, binning in [(None, 1), ((0, 256, 10, 60), 1), (None, 2)]:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            res = reduction.stream_projections(
+                his,
+                np.arange(60),
+                ("max", "std", "median"),
+                memory_budget=budget,
+                roi=roi,
+                binning=binning,
+            )
+            peak = tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+        # the read rows, binning, the deviations for std and the median's copy
+        assert peak < budget
+
+        r = roi or (0, 256, 0, 256)
+        expected = bin_frames(frames[:, r[0] : r[1], r[2] : r[3]], binning)
+        np.testing.assert_array_equal(res["max"], expected.max(axis=0))
+        np.testing.assert_allclose(res["std"], expected.std(axis=0), rtol=1e-8)
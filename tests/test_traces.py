@@ -0,0 +1,35 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 21:12:40
+# @Last Modified: 2026-10-17 21:12:40
+# ------------------------------------------------------------------------------ #
+
+import numpy as np
+
+import instrumentation
+import synthetic_his
+import traces
+from his_opener import HisOpener
+
+
+def test_traces_read_only_roi_rows(tmp_path):
+    path = str(tmp_path / "traces.his")
+    rng = np.random.default_rng(3)
+    frames = rng.integers(0, 60000, size=(20, 128, 128), dtype=np.uint16)
+    synthetic_his.write_his(path, frames=frames)
+    stats = instrumentation.Stats()
+    his = HisOpener(path, stats=stats, use_index_cache=False)
+    stats.totals["bytes_read"] = 0
+
+    points = np.array([[30, 40], [60, 50]])
+    res = traces.extract_traces(his, points, roi_width=10)
+
+    rois, rows, cols = traces.roi_pixels(points, 10, (128, 128))
+    for idx in range(len(points)):
+        sel = rois == idx
+        expected = frames[:, rows[sel], cols[sel]].mean(axis=1)
+        np.testing.assert_allclose(res[:, idx], expected, rtol=1e-5)
+    # only the rows around the rois, about a fifth of every frame
+    num_rows = rows.max() - rows.min() + 1
+    assert stats.totals["bytes_read"] < 1.1 * 20 * num_rows * 128 * 2
@@ -0,0 +1,58 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 22:52:44
+# @Last Modified: 2026-10-17 22:52:44
+# ------------------------------------------------------------------------------ #
+
+
+import synthetic_his
+import watch
+
+
+def write_part(src, dst, num_bytes):
+    with open(src, "rb") as f:
+        data = f.read(num_bytes)
+    with open(dst, "wb") as f:
+        f.write(data)
+
+
+def test_folder_watcher_poll(tmp_path):
+    folder = tmp_path / "acquisition"
+    folder.mkdir()
+    full = str(tmp_path / "full.his")
+    size = synthetic_his.write_his(full, num_frames=10, width=32, height=32)
+
+    old = str(folder / "old.his")
+    running = str(folder / "running.his")
+    synthetic_his.write_his(old, num_frames=4, width=32, height=32)
+    # a recording that was started before the watcher
+    write_part(full, running, size // 3)
+
+    watcher = watch.FolderWatcher(str(folder), stable_polls=1)
+    assert watcher.poll() == []
+
+    # a new recording, still being written
+    growing = str(folder / "growing.his")
+    write_part(full, growing, size // 2)
+    write_part(full, running, size // 2)
+    assert watcher.poll() == []
+    # the size did not change, but frames are missing
+    assert watcher.poll() == []
+
+    # both are complete now
+    write_part(full, growing, size)
+    write_part(full, running, size)
+    assert watcher.poll() == []
+    assert watcher.poll() == [growing, running]
+    # every file is reported once, files that were there before never
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+
+
+def test_folder_watcher_include_existing(tmp_path):
+    old = str(tmp_path / "old.his")
+    synthetic_his.write_his(old, num_frames=4, width=32, height=32)
+    watcher = watch.FolderWatcher(str(tmp_path), stable_polls=1, include_existing=True)
+    assert watcher.poll() == []
+    assert watcher.poll() == [old]
@@ -0,0 +1,163 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 16:21:53
+# @Last Modified: 2026-10-17 16:21:53
+# ------------------------------------------------------------------------------ #
+# Fluorescence traces of all rois, with a single pass over the stack.
+#
+# Every roi is a square of roi_width pixels. All squares are combined into one
+# sparse matrix rois * pixels, so the traces of a frame are a single
+# (sparse) matrix-vector product. Frames are read in file order, the next chunk is
+# read while the current one is processed, and the traces are written to
+# a memory mapped .npy file as they come in.
+# ------------------------------------------------------------------------------ #
+
+import concurrent.futures
+import numpy as np
+from scipy import sparse
+
+import reduction
+from his_opener import HisOpener
+
+
+def roi_pixels(points, roi_width, shape):
+    """
+        Pixels covered by every roi: a square of `roi_width` around the
+        (rounded) center, as exported by save_rois. Pixels outside the
+        frame `shape` (height, width) are dropped.
+
+        Returns:
+            rois, rows, cols : 1d arrays, one entry per pixel
+    """
+    points = np.asarray(points)
+    d = int(np.floor(roi_width / 2))
+    offsets = np.arange(-d, d)
+    cols = np.rint(points[:, 0]).astype(np.int64)
+    rows = np.rint(points[:, 1]).astype(np.int64)
+    r = rows[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    c = cols[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    r, c = np.broadcast_arrays(r, c)
+    rois = np.broadcast_to(np.arange(len(points))[:, np.newaxis, np.newaxis], r.shape)
+    inside = (r >= 0) & (r < shape[0]) & (c >= 0) & (c < shape[1])
+    return rois[inside], r[inside], c[inside]
+
+
+def roi_matrix(points, roi_width, shape, func="mean", row_range=None):
+    """
+        Sparse matrix rois * pixels, so that `matrix @ frame.ravel()` gives
+        the mean (or sum, with func="sum") of every roi in the frame.
+
+        Parameters:
+            points : array, columns col, row, (id)
+            shape : (height, width) of the frames
+            row_range : (start, stop), if only these rows of the frames
+                are passed in. Default: all rows.
+    """
+    assert func in ["mean", "sum"], f"Unknown func {func}"
+    if row_range is None:
+        row_range = (0, shape[0])
+    rois, rows, cols = roi_pixels(points, roi_width, shape)
+    assert np.all((rows >= row_range[0]) & (rows < row_range[1]))
+    num_pixels = (row_range[1] - row_range[0]) * shape[1]
+    pixels = (rows - row_range[0]) * shape[1] + cols
+
+    weights = np.ones(len(rois), dtype=np.float32)
+    if func == "mean":
+        counts = np.bincount(rois, minlength=len(points))
+        weights /= counts[rois]
+    matrix = sparse.csr_matrix(
+        (weights, (rois, pixels)), shape=(len(points), num_pixels), dtype=np.float32
+    )
+    return matrix
+
+
+def extract_traces(
+    his,
+    points,
+    roi_width=10,
+    output=None,
+    frames=None,
+    func="mean",
+    chunk_size=None,
+    memory_budget=None,
+):
+    """
+        Reads every frame of the stack once and computes the mean (or sum)
+        intensity of all rois.
+
+        Parameters:
+            his : HisOpener or path to a .his file
+            points : array of (aligned) rois, columns col, row, (id),
+                e.g. mov_points from pipeline.transform_points
+            roi_width : size of the square of every roi, see roi_pixels
+            output : path to a .npy file that the traces are written to while
+                reading (as memory map), so they never have to fit in memory.
+                None to return a normal array.
+            frames : frame indices (default all)
+            func : "mean" or "sum"
+            chunk_size : number of frames per read. By default chosen so that
+                two chunks fit into `memory_budget` (reduction.DEFAULT_MEMORY_BUDGET)
+
+        Returns:
+            float32 array frame_number * roi_number (a memory map if
+            `output` is given). Rois that are completely outside of the frame
+            are nan.
+    """
+    if not isinstance(his, HisOpener):
+        his = HisOpener(his)
+    if frames is None:
+        frames = np.arange(his.num_frames)
+    frames = np.asarray(frames)
+    if memory_budget is None:
+        memory_budget = reduction.DEFAULT_MEMORY_BUDGET
+
+    # only read the rows that contain rois
+    shape = (his.height, his.width)
+    rois, rows, cols = roi_pixels(points, roi_width, shape)
+    if len(rows) > 0:
+        row_range = (int(rows.min()), int(rows.max()) + 1)
+    else:
+        row_range = (0, 1)
+    matrix = roi_matrix(points, roi_width, shape, func, row_range)
+    roi = (row_range[0], row_range[1], 0, his.width)
+    missing = np.bincount(rois, minlength=len(points)) == 0
+
+    if chunk_size is None:
+        # the chunk being read and the one being processed
+        frame_bytes = (row_range[1] - row_range[0]) * his.width
+        frame_bytes *= np.dtype(his.pixel_type).itemsize
+        chunk_size = memory_budget // (2 * frame_bytes)
+    chunk_size = int(max(1, chunk_size))
+
+    out_shape = (len(frames), len(points))
+    if output is None:
+        traces = np.empty(out_shape, dtype=np.float32)
+    else:
+        traces = np.lib.format.open_memmap(
+            output, mode="w+", dtype=np.float32, shape=out_shape
+        )
+
+    def read(start):
+        return his.read_frame_stack(frames[start : start + chunk_size], roi=roi)
+
+    starts = range(0, len(frames), chunk_size)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(read, 0) if len(frames) > 0 else None
+        for start in starts:
+            chunk = future.result()
+            if start + chunk_size < len(frames):
+                future = executor.submit(read, start + chunk_size)
+            # one sparse matrix-vector product per frame, directly on the
+            # pixel type. this stays in cache and is faster than a single
+            # product with the whole chunk
+            res = np.empty((len(chunk), len(points)), dtype=np.float32)
+            for idx, frame in enumerate(chunk):
+                res[idx] = matrix @ frame.ravel()
+            traces[start : start + len(chunk)] = res
+            del chunk
+
+    traces[:, missing] = np.nan
+    if output is not None:
+        traces.flush()
+    return traces
@@ -2,7 +2,7 @@
 # @Author:        F. Paul Spitzner
 # @Email:         paul.spitzner@ds.mpg.de
 # @Created:       2020-01-13 19:03:56
-# @Last Modified: 2020-02-06 13:50:11
+# @Last Modified: 2026-10-17 13:41:26
 # ------------------------------------------------------------------------------ #
 # Helper functions
 # ------------------------------------------------------------------------------ #
@@ -15,16 +15,30 @@ def paint_roi(col, row, width, img, channel=0, alpha=123):
     """
         add a square to the img to mark provided coordinate
     """
-    row = int(row)
-    col = int(col)
+    paint_rois(np.array([[col, row]], dtype=float), width, img, channel, alpha)
+
+
+def paint_rois(points, width, img, channel=0, alpha=123, chunk_size=4096):
+    """
+        add a square to the img for every point, all at once.
+        points has shape (N, 2) or more columns: col, row, (ignored)
+        Same result as calling paint_roi for every point: squares are clipped
+        to the image edges and pixels outside are moved onto the edge.
+    """
+    points = np.asarray(points)
     d = int(np.floor(width / 2))
-    grid = np.mgrid[col - d : col + d, row - d : row + d]
-    grid[grid < 0] = 0
-    grid[0][grid[0] >= img.shape[0]] = img.shape[0] - 1
-    grid[1][grid[1] >= img.shape[1]] = img.shape[1] - 1
-    for idx in range(0, grid.shape[1]):
-        c = grid[0, idx]
-        r = grid[1, idx]
+    offsets = np.arange(-d, d)
+    # chunks of points, so the index arrays stay small
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        # int() truncates towards zero
+        cols = np.trunc(chunk[:, 0]).astype(np.int64)
+        rows = np.trunc(chunk[:, 1]).astype(np.int64)
+        c = np.clip(cols[:, np.newaxis] + offsets, 0, img.shape[1] - 1)
+        r = np.clip(rows[:, np.newaxis] + offsets, 0, img.shape[0] - 1)
+        # all pairs of r and c of the same point
+        r = r[:, :, np.newaxis]
+        c = c[:, np.newaxis, :]
         img[r, c, channel] = 255
         img[r, c, 3] = alpha
 
@@ -46,19 +60,95 @@ def base_name(source_file, extension_delim="."):
     base_name = '.'.join(map(str, base_name))
     return base_name
 
-def save_rois(fname, roi_id, x, y, roi_width, img_width=1024):
+def out_of_bounds(x, y, roi_width, img_width=1024, img_height=None):
+    """
+        True for rois whose square might reach out of the image.
+        x and y can have any (matching) shape, e.g. sessions * rois
+    """
+    if img_height is None:
+        img_height = img_width
+    half = roi_width / 2
+    return (x > img_width - half) | (y > img_height - half) | (x < half) | (y < half)
+
+
+def _roi_csv(roi_id, x, y, roi_width):
+    """
+        the content of a netcal roi file, same as np.savetxt with
+        fmt="%d,%.0f,%.0f,%d", but formatted in one go
+    """
+    out_dat = np.empty((len(x), 4))
+    out_dat[:, 0] = np.trunc(roi_id)
+    out_dat[:, 1] = np.rint(x)
+    out_dat[:, 2] = np.rint(y)
+    out_dat[:, 3] = np.trunc(roi_width)
+    fmt = "%d,%.0f,%.0f,%d"
+    if not np.all(np.isfinite(out_dat)):
+        rows = ((fmt + "\n") * len(x)) % tuple(out_dat.ravel().tolist())
+        return "%ROI,X,Y,Width\n" + rows
+    # integers format faster. %.0f rounds like rint but keeps "-0"
+    values = tuple(out_dat.astype(np.int64).ravel().tolist())
+    rows = ("%d,%d,%d,%d\n" * len(x)) % values
+    negative_zero = np.where(np.any((out_dat == 0) & np.signbit(out_dat), axis=1))[0]
+    if len(negative_zero) > 0:
+        rows = rows.split("\n")
+        for idx in negative_zero:
+            rows[idx] = fmt % tuple(out_dat[idx])
+        rows = "\n".join(rows)
+    return "%ROI,X,Y,Width\n" + rows
+
+
+def save_rois(fname, roi_id, x, y, roi_width, img_width=1024, img_height=None):
     """
         save in the format that works with netcal (legacy): id | x | y | roi_width
         netcal does not like floats for the coordinates and
         comments have to be indicated with %
+        img_height defaults to img_width
+    """
+    flagged = np.where(out_of_bounds(x, y, roi_width, img_width, img_height))[0]
+    for idx in flagged:
+        print(f"ROI {roi_id[idx]} at {x[idx]} | {y[idx]} might be out of the image")
+    with open(fname, "w") as f:
+        f.write(_roi_csv(roi_id, x, y, roi_width))
+
+
+def save_rois_batch(
+    fnames,
+    roi_id,
+    x,
+    y,
+    roi_width,
+    img_width=1024,
+    img_height=None,
+    npz_path=None,
+    names=None,
+):
+    """
+        save the rois of many sessions at once, e.g. from
+        pipeline.transform_points_batch.
+        x and y have shape sessions * rois, roi_id is the same for all sessions.
+        `fnames` are the netcal roi files, one per session (None to skip them).
+        If `npz_path` is given, everything is also saved to one .npz file
+        with roi_id, x, y (sessions * rois), flagged and names
+        (of the sessions, default fnames).
     """
-    flagged = np.zeros_like(x, dtype=bool)
-    flagged[np.where(x > img_width-roi_width/2)] = True
-    flagged[np.where(y > img_width-roi_width/2)] = True
-    flagged[np.where(x < roi_width/2)] = True
-    flagged[np.where(y < roi_width/2)] = True
-    for idx, roi in enumerate(roi_id[flagged]):
-        print(f"ROI {roi} at {x[idx]} | {y[idx]} might be out of the image")
-    out_dat = np.vstack((roi_id, x, y, np.ones_like(x) * roi_width)).T
-    np.savetxt(fname, out_dat, fmt="%d,%.0f,%.0f,%d", header="ROI,X,Y,Width", comments="%"
-    )
+    x = np.atleast_2d(x)
+    y = np.atleast_2d(y)
+    flagged = out_of_bounds(x, y, roi_width, img_width, img_height)
+    if fnames is not None:
+        for k, fname in enumerate(fnames):
+            num_flagged = np.sum(flagged[k])
+            if num_flagged > 0:
+                print(f"{num_flagged} ROIs in {fname} might be out of the image")
+            with open(fname, "w") as f:
+                f.write(_roi_csv(roi_id, x[k], y[k], roi_width))
+    if npz_path is not None:
+        np.savez(
+            npz_path,
+            roi_id=roi_id,
+            x=x,
+            y=y,
+            roi_width=roi_width,
+            flagged=flagged,
+            names=np.array(fnames if names is None else names, dtype=str),
+        )
+    return flagged
@@ -0,0 +1,275 @@
+# ------------------------------------------------------------------------------ #
+# @Author:        F. Paul Spitzner
+# @Email:         paul.spitzner@ds.mpg.de
+# @Created:       2026-10-17 17:58:03
+# @Last Modified: 2026-10-17 17:58:03
+# ------------------------------------------------------------------------------ #
+# Service mode: watches a folder for new recordings and aligns every .his file
+# as soon as it is completely written.
+#
+# The reference image and rois are loaded once and kept in the worker
+# processes, so a new file only costs its own projection and registration.
+# Uses the settings from align_his_stackreg.py, run with
+#
+# python watch.py
+#
+# and stop with ctrl+c.
+# ------------------------------------------------------------------------------ #
+
+import os
+import time
+import collections
+import concurrent.futures
+
+import pipeline
+import registration
+from his_opener import HisOpener
+
+
+def is_complete(file_path):
+    """
+        True if all frames announced in the header are on disk.
+        Files that are still being written (or broken) give False.
+    """
+    try:
+        his = HisOpener(file_path, skip_consistency_check=True, use_index_cache=False)
+    except Exception:
+        # not even the first frames are written
+        return False
+    try:
+        num_frames = his.num_frames
+        if num_frames < 1:
+            return False
+        size = os.path.getsize(file_path)
+        expected = int(his.get_frame_pos(num_frames - 1))
+        expected += his.head_offset + his.frame_offset + his.img_size
+        if num_frames == 1:
+            expected = his.head_offset + his.base_offset + his.img_size
+        if size != expected:
+            # header sizes vary, need to find the frames
+            his.check_consistency()
+        last = num_frames - 1
+        pos = int(his.get_frame_pos(last))
+        if pos < 0:
+            # not found by the thorough check
+            return False
+        offset = his.frame_offset if last > 0 else his.base_offset
+        if his.lookup_offset is not None:
+            offset = int(his.lookup_offset[last])
+        return (
+            his._read_at(pos, 2) == b"IM"
+            and pos + his.head_offset + offset + his.img_size <= size
+        )
+    except (IndexError, ValueError, AssertionError):
+        return False
+    finally:
+        del his
+
+
+class FolderWatcher:
+    """
+        Finds .his files in `folder` that are complete: their size did not
+        change for `stable_polls` calls of poll() and all frames are on disk
+        (see is_complete). Every file is reported once.
+
+        Unless `include_existing`, files that are already in the folder when
+        the watcher is created are ignored, as long as they do not grow
+        (a recording that was running at that time is still reported).
+    """
+
+    def __init__(
+        self, folder, extensions=(".his",), stable_polls=2, include_existing=False
+    ):
+        self.folder = os.path.expanduser(folder)
+        self.extensions = tuple([e.lower() for e in extensions])
+        self.stable_polls = stable_polls
+        self.sizes = dict()  # file -> (size, number of polls without change)
+        self.incomplete = dict()  # file -> size at which is_complete failed
+        self.done = set()
+        self.existing = dict()  # file -> size when the watcher was created
+        if not include_existing:
+            for path in self._list():
+                try:
+                    self.existing[path] = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+
+    def _list(self):
+        paths = []
+        for name in sorted(os.listdir(self.folder)):
+            if name.lower().endswith(self.extensions):
+                paths.append(os.path.join(self.folder, name))
+        return paths
+
+    def poll(self):
+        """
+            Files that became complete since the last call
+        """
+        new = []
+        for path in self._list():
+            if path in self.done:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if path in self.existing:
+                if self.existing[path] == size:
+                    continue
+                # still being written when the watcher started
+                self.existing.pop(path)
+            last_size, count = self.sizes.get(path, (None, 0))
+            count = count + 1 if size == last_size else 0
+            self.sizes[path] = (size, count)
+            if count < self.stable_polls or self.incomplete.get(path) == size:
+                continue
+            if is_complete(path):
+                self.done.add(path)
+                self.sizes.pop(path)
+                self.incomplete.pop(path, None)
+                new.append(path)
+            else:
+                self.incomplete[path] = size
+        return new
+
+
+def watch(
+    folder,
+    ref_img,
+    ref_points,
+    output_paths,
+    settings,
+    num_workers=2,
+    poll_interval=30,
+    stable_polls=2,
+    max_polls=None,
+    include_existing=False,
+):
+    """
+        Aligns new files in `folder` until interrupted (ctrl+c).
+
+        Parameters:
+            ref_img : the stretched reference image
+            ref_points : array of rois, columns col, row, id
+            output_paths : function(file) -> (roi_path, img_path). Files whose
+                preview already exists are skipped.
+            settings : see pipeline.make_settings
+            num_workers : number of files aligned at the same time. Further
+                files wait in a queue.
+            poll_interval : seconds between checks of the folder
+            stable_polls : a file is complete once its size did not change for
+                this many checks (and all frames are written)
+            max_polls : stop after this many checks (and when all queued files
+                are done). None to run until interrupted.
+            include_existing : if True, files that are already in the folder
+                are aligned, too. By default only new recordings (and those
+                still being written) are, see FolderWatcher.
+
+        Returns:
+            list of results, see pipeline.align_batch
+    """
+    if settings["coarse_to_fine"]:
+        ref_img = registration.ReferenceTemplate(
+            ref_img, rotation=settings["estimate_rotation"]
+        )
+    watcher = FolderWatcher(
+        folder, stable_polls=stable_polls, include_existing=include_existing
+    )
+    waiting = collections.deque()
+    pending = set()
+    results = []
+    polls = 0
+
+    def report(res):
+        results.append(res)
+        status = "Aligned" if res["error"] is None else "Failed"
+        print(f"{status} {res['file']} ({res['duration']:.1f}s)")
+        if res["error"] is not None:
+            print(res["error"])
+
+    print(f"Watching {folder}, stop with ctrl+c")
+    # job of every submitted task, to report it if its worker dies
+    submitted = dict()
+    with pipeline.RestartingPool(
+        max_workers=num_workers,
+        initializer=pipeline._init_worker,
+        initargs=(ref_img, ref_points, settings),
+    ) as executor:
+        try:
+            while max_polls is None or polls < max_polls or waiting or pending:
+                if max_polls is None or polls < max_polls:
+                    for path in watcher.poll():
+                        roi_path, img_path = output_paths(path)
+                        if os.path.exists(img_path):
+                            print(f"Skipping {path}")
+                            continue
+                        print(f"Queued {path}")
+                        waiting.append((path, roi_path, img_path))
+                    polls += 1
+
+                # bounded: only as many files in flight as there are workers
+                while waiting and len(pending) < num_workers:
+                    job = waiting.popleft()
+                    future = executor.submit(pipeline._align_task, len(results), *job)
+                    submitted[future] = job
+                    pending.add(future)
+
+                if len(pending) == 0:
+                    time.sleep(poll_interval)
+                    continue
+                done, pending = concurrent.futures.wait(
+                    pending,
+                    timeout=poll_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    job = submitted.pop(future)
+                    report(
+                        pipeline.result_or_error(
+                            future,
+                            lambda error: pipeline.failed_result(
+                                len(results), job[0], error
+                            ),
+                        )
+                    )
+        except KeyboardInterrupt:
+            print(f"Stopping, {len(waiting)} queued files were not aligned")
+            for future in pending:
+                future.cancel()
+
+    return results
+
+
+def main():
+    # same settings as for the batch
+    import align_his_stackreg as cfg
+
+    ref_img, ref_points, _ = cfg.load_reference()
+    settings = pipeline.make_settings(
+        roi_width=cfg.roi_width,
+        use_average=cfg.use_average,
+        frames_for_average=cfg.frames_for_average,
+        frame_sampling=cfg.frame_sampling,
+        projection_cache_dir=cfg.projection_cache_dir,
+        projection_cache_bytes=cfg.projection_cache_max_gb * 1024 ** 3,
+        coarse_to_fine=cfg.coarse_to_fine,
+        estimate_rotation=cfg.estimate_rotation,
+    )
+    num_workers = cfg.num_workers
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    watch(
+        cfg.watch_folder,
+        ref_img,
+        ref_points,
+        cfg.output_paths,
+        settings,
+        num_workers=num_workers,
+        poll_interval=cfg.watch_interval,
+        stable_polls=cfg.watch_stable_polls,
+        include_existing=cfg.watch_include_existing,
+    )
+
+
+if __name__ == "__main__":
+    main()